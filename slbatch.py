@@ -0,0 +1,292 @@
+import argparse, glob, json, os, sys, time
+from concurrent import futures
+
+import slsolve
+
+
+class Deadline:
+    '''
+    A stop signal for solve_puzzle() that is set once the specified number
+    of seconds has passed.  The search only checks it now and then, so a
+    puzzle can run a little past its deadline before it is given up on.
+    '''
+
+    def __init__(self, seconds):
+        self.end = time.monotonic() + seconds
+
+    def is_set(self):
+        return time.monotonic() >= self.end
+
+
+def iter_puzzle_files(paths, manifest=None):
+    '''
+    Generates the puzzle files to solve, one at a time.  Each path may be a
+    puzzle file, a directory (every *.txt and *.txt.gz file in it is
+    solved), or a glob pattern.  If manifest is specified, it is a file
+    listing one puzzle file per line, or '-' for standard input; blank
+    lines and lines starting with '#' are skipped, and relative paths are
+    taken relative to the manifest's directory.
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path)
+                           if n.endswith(('.txt', '.txt.gz')))
+            for name in names:
+                yield os.path.join(path, name)
+        elif glob.has_magic(path):
+            for name in sorted(glob.glob(path)):
+                yield name
+        else:
+            yield path
+
+    if manifest is None:
+        return
+
+    if manifest == '-':
+        f = sys.stdin
+        base = ''
+    else:
+        f = open(manifest)
+        base = os.path.dirname(manifest)
+
+    try:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            yield os.path.join(base, line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def board_lines(p):
+    '''
+    Returns the solved board as a list of strings, one per row of dots and
+    row of cells, in the same layout that pretty_print() uses but without
+    the spaces between positions.
+    '''
+    lines = []
+    for r in range(1, 2 * p.rows + 2):
+        row_start = r * p.board_width
+        lines.append(p.board[row_start + 1:row_start + 2 * p.cols + 2]
+                     .decode('ascii'))
+    return lines
+
+
+def iter_puzzle_tasks(filenames):
+    '''
+    Generates the puzzles in each of the puzzle files, reading each file
+    as it goes, so that a file holding many puzzles is never read in all
+    at once.  Each puzzle is generated as a pair (record, data), where
+    record is the start of its result record, giving the file, the
+    puzzle's index in the file and its name if it has one, and data is
+    (rows, cols, cell_values).  If a file can't be read, data is None and
+    the record is an error record for the rest of the file.
+    '''
+    for filename in filenames:
+        index = 0
+        try:
+            for (name, rows, cols, cell_values) in \
+                    slsolve.iter_puzzle_data(filename):
+                record = {'file': filename, 'index': index}
+                if name is not None:
+                    record['name'] = name
+                yield (record, (rows, cols, cell_values))
+                index += 1
+
+            if index == 0:
+                raise ValueError('%s:  no puzzles in the file' % filename)
+
+        except (OSError, ValueError) as e:
+            record = {
+                'file': filename,
+                'index': index,
+                'status': 'error',
+                'error': '%s: %s' % (type(e).__name__, e),
+                'time': 0.0,
+                'nodes': 0,
+                'max_depth': 0,
+            }
+            yield (record, None)
+
+
+def solve_task(task):
+    '''
+    Solves one puzzle in a worker process, and returns its result record.
+    The task is a tuple (record, data, settings), where record and data
+    come from iter_puzzle_tasks(), and settings is a dictionary of keyword
+    arguments for solve_puzzle() plus 'timeout', the number of seconds to
+    give the puzzle (or None for no limit), and 'count_solutions', a limit
+    for count_solutions() (or None to just solve the puzzle).
+
+    The record's status is 'solved', 'unsolved' (the search finished
+    without finding a solution), 'timeout' or 'error'.  When counting,
+    the record also gives the number of solutions found.
+    '''
+    (record, (rows, cols, cell_values), settings) = task
+    settings = dict(settings)
+    timeout = settings.pop('timeout')
+    limit = settings.pop('count_solutions', None)
+
+    record = dict(record)
+    stats = slsolve.SearchStats()
+    start = time.perf_counter()
+    try:
+        p = slsolve.Puzzle(rows, cols, cell_values)
+        stop = None
+        if timeout is not None:
+            stop = Deadline(timeout)
+
+        if limit is not None:
+            count = slsolve.count_solutions(p, limit, stats=stats, stop=stop,
+                                            **settings)
+            solved = bool(count)
+            if count is not None:
+                record['solutions'] = count
+        else:
+            solved = slsolve.solve_puzzle(p, stats=stats, stop=stop,
+                                          **settings)
+
+        if solved:
+            record['status'] = 'solved'
+        elif stop is not None and stop.is_set():
+            record['status'] = 'timeout'
+        else:
+            record['status'] = 'unsolved'
+
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+
+    record['time'] = round(time.perf_counter() - start, 4)
+    record['nodes'] = stats.nodes
+    record['max_depth'] = stats.max_depth
+    if record['status'] == 'solved':
+        record['solution'] = board_lines(p)
+
+    return record
+
+
+def solve_batch(filenames, settings, out, jobs=1, tasks_per_worker=100):
+    '''
+    Solves every puzzle in the puzzle files from the filenames iterable on
+    a pool of jobs worker processes, writing each result record to out as
+    a line of JSON as soon as the puzzle finishes.  Records are written in
+    the order that puzzles finish, not the order of the filenames.
+
+    Only a couple of puzzles per worker are handed out at a time, so the
+    filenames and the puzzle files are read as the batch goes rather than
+    all at once.  Each worker process is replaced after solving
+    tasks_per_worker puzzles, so memory that a worker holds on to doesn't
+    build up over a long batch.  Returns a dictionary counting the records
+    of each status.
+    '''
+    counts = {}
+    tasks = iter_puzzle_tasks(filenames)
+
+    def write_record(record):
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+        status = record['status']
+        counts[status] = counts.get(status, 0) + 1
+
+    with futures.ProcessPoolExecutor(max_workers=jobs,
+                                     max_tasks_per_child=tasks_per_worker) \
+            as executor:
+        running = set()
+        more = True
+        while more or len(running) > 0:
+            while more and len(running) < 2 * jobs:
+                task = next(tasks, None)
+                if task is None:
+                    more = False
+                elif task[1] is None:
+                    write_record(task[0])
+                else:
+                    task += (settings,)
+                    running.add(executor.submit(solve_task, task))
+
+            if len(running) == 0:
+                break
+
+            (done, running) = futures.wait(running,
+                return_when=futures.FIRST_COMPLETED)
+
+            for future in done:
+                write_record(future.result())
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Solves many Slitherlink puzzles, writing one JSON ' +
+                    'record per puzzle.')
+    parser.add_argument('paths', nargs='*',
+        help='puzzle files, which may hold many puzzles each, directories ' +
+             'of *.txt and *.txt.gz puzzle files, or glob patterns')
+    parser.add_argument('--manifest',
+        help="a file listing one puzzle file per line, or '-' to read " +
+             'the list from standard input')
+    parser.add_argument('--output', default='-',
+        help="the file to write the JSONL records to (default '-', " +
+             'standard output)')
+    parser.add_argument('--jobs', type=slsolve.positive_int,
+        default=os.cpu_count() or 1,
+        help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--timeout', type=float,
+        help='the number of seconds to spend on each puzzle before ' +
+             'giving up')
+    parser.add_argument('--tasks-per-worker', type=slsolve.positive_int,
+        default=100,
+        help='the number of puzzles each worker process solves before ' +
+             'it is replaced (default 100)')
+    parser.add_argument('--count-solutions', type=slsolve.positive_int,
+        metavar='LIMIT',
+        help='count the solutions of each puzzle, up to LIMIT of them; ' +
+             'e.g. 2 checks that each solution is unique')
+    parser.add_argument('--sweep', action='store_true',
+        help='apply the rules by sweeping the whole board on every pass')
+    parser.add_argument('--probes', type=int, default=0, metavar='N',
+        help='before branching, try up to N edge values at each search ' +
+             'node (default 0)')
+    parser.add_argument('--heuristic',
+        choices=sorted(slsolve.BRANCHING_HEURISTICS), default='constrained',
+        help='how the depth-first search picks the edge to branch on')
+    parser.add_argument('--seed', type=int,
+        help='seed for the random choices made during the search')
+
+    args = parser.parse_args()
+    if len(args.paths) == 0 and args.manifest is None:
+        parser.error('no puzzle files specified')
+
+    settings = {
+        'worklist': not args.sweep,
+        'heuristic': args.heuristic,
+        'probes': args.probes,
+        'seed': args.seed,
+        'timeout': args.timeout,
+        'count_solutions': args.count_solutions,
+    }
+
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+
+    try:
+        counts = solve_batch(iter_puzzle_files(args.paths, args.manifest),
+                             settings, out, args.jobs, args.tasks_per_worker)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    summary = ', '.join('%d %s' % (counts[s], s) for s in sorted(counts))
+    print('Finished %d puzzles:  %s' % (sum(counts.values()), summary or 'none'),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+import argparse, json, os, platform, re, sys, time, tracemalloc
+
+import slsat, slsolve
+from slbatch import Deadline, iter_puzzle_files
+
+
+# Matches the puzzle file names in the puzzles folder, such as
+# 10x10_hard_1.txt, to find the size and difficulty of each puzzle.
+PUZZLE_NAME = re.compile(r'^(\d+x\d+)_(?:([a-z]+)_)?\d+\.txt$')
+
+
+def puzzle_kind(filename):
+    '''
+    Returns the (size, difficulty) of a puzzle file from its name, e.g.
+    ('10x10', 'hard'), using None for any part the name doesn't give.
+    '''
+    m = PUZZLE_NAME.match(os.path.basename(filename))
+    if m is None:
+        return (None, None)
+    return (m.group(1), m.group(2))
+
+
+def select_puzzles(filenames, sizes=None, difficulties=None):
+    '''
+    Generates the puzzle files whose size is in sizes and difficulty is in
+    difficulties.  Either filter can be None to allow every puzzle.
+    '''
+    for filename in filenames:
+        (size, difficulty) = puzzle_kind(filename)
+        if sizes is not None and size not in sizes:
+            continue
+        if difficulties is not None and difficulty not in difficulties:
+            continue
+        yield filename
+
+
+def percentile(values, pct):
+    '''
+    Returns the pct'th percentile of the values, using the nearest-rank
+    method, so that the result is always one of the values.
+    '''
+    values = sorted(values)
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+# The solving engines that can be benchmarked, each called as
+# solve(puzzle, stats=..., stop=..., **settings).
+ENGINES = {
+    'rules': slsolve.solve_puzzle,
+    'sat': slsat.solve_puzzle_sat,
+}
+
+
+def run_once(filename, settings, timeout, trace_memory=False,
+             rule_stats=None):
+    '''
+    Loads and solves the puzzle once with the engine named by the
+    settings' 'engine' entry (the rules and search by default), and
+    returns a tuple (status, time, nodes, passes, peak), where status is
+    'solved', 'unsolved' or 'timeout', and time is the wall time in
+    seconds for loading and solving.  If trace_memory is True then peak is the peak memory in
+    bytes allocated while solving, as measured by tracemalloc; otherwise
+    it is None.  If rule_stats is a RuleStats object, the work done by
+    each rule is counted in it.
+    '''
+    settings = dict(settings)
+    solve = ENGINES[settings.pop('engine', 'rules')]
+
+    stats = slsolve.SearchStats()
+    stop = None
+    if timeout is not None:
+        stop = Deadline(timeout)
+
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        p = slsolve.load_puzzle(filename)
+        p.rule_stats = rule_stats
+        solved = solve(p, stats=stats, stop=stop, **settings)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    if solved:
+        status = 'solved'
+    elif stop is not None and stop.is_set():
+        status = 'timeout'
+    else:
+        status = 'unsolved'
+
+    return (status, elapsed, stats.nodes, p.passes, peak)
+
+
+def bench_puzzle(filename, settings, repeat, timeout, rule_stats=False):
+    '''
+    Solves the puzzle repeat times, plus once more with tracemalloc on to
+    measure its peak memory, and returns the result as a dictionary.  The
+    search makes the same choices every time, so the nodes and passes are
+    taken from the first run; only the times vary.  If rule_stats is True,
+    the puzzle is solved once more to count the work done by each rule,
+    which is added to the result as 'rules' (see RuleStats.as_dict()).
+    '''
+    times = []
+    for i in range(repeat):
+        (status, elapsed, nodes, passes, peak) = \
+            run_once(filename, settings, timeout)
+        times.append(elapsed)
+        if i == 0:
+            result = {'status': status, 'nodes': nodes, 'passes': passes}
+        if status == 'timeout':
+            # There is no point timing a puzzle out more than once.
+            break
+
+    if result['status'] != 'timeout':
+        # tracemalloc slows the solver down a lot, so it gets a run of its
+        # own rather than skewing the times.
+        result['peak_memory'] = run_once(filename, settings, timeout,
+                                         trace_memory=True)[4]
+
+        if rule_stats:
+            stats = slsolve.RuleStats()
+            run_once(filename, settings, timeout, rule_stats=stats)
+            result['rules'] = stats.as_dict()
+
+    result['runs'] = len(times)
+    result['median_time'] = round(percentile(times, 50), 6)
+    result['p95_time'] = round(percentile(times, 95), 6)
+    return result
+
+
+def bench_passes(filename, settings, repeat, rule_stats=False):
+    '''
+    Times only the rules on the puzzle's starting board, without any
+    search, repeat times, and returns the result as a dictionary.  The
+    status tells whether the rules alone solved the puzzle.  The time per
+    pass is the median time divided by the number of passes the rules
+    made, which is the same on every run.  If rule_stats is True, the
+    rules are run once more to count their work, as in bench_puzzle().
+    '''
+    times = []
+    for i in range(repeat):
+        p = slsolve.load_puzzle(filename)
+        start = time.perf_counter()
+        p.iter_solve(worklist=settings['worklist'])
+        times.append(time.perf_counter() - start)
+
+    if p.is_solved():
+        status = 'solved'
+    else:
+        status = 'unsolved'
+
+    median = percentile(times, 50)
+    result = {
+        'status': status,
+        'passes': p.passes,
+        'median_time': round(median, 6),
+        'pass_time': round(median / p.passes, 6),
+    }
+
+    if rule_stats:
+        p = slsolve.load_puzzle(filename)
+        p.rule_stats = slsolve.RuleStats()
+        p.iter_solve(worklist=settings['worklist'])
+        result['rules'] = p.rule_stats.as_dict()
+
+    return result
+
+
+def run_pass_benchmarks(filenames, settings, repeat=5, out=None,
+                        rule_stats=False):
+    '''
+    Runs bench_passes() on each of the puzzle files, and returns the
+    results in the same form as run_benchmarks().
+    '''
+    results = {}
+    for filename in filenames:
+        result = bench_passes(filename, settings, repeat, rule_stats)
+        name = os.path.basename(filename)
+        results[name] = result
+        if out is not None:
+            out.write('%-22s %-8s %5d passes  %9.4f s  %9.6f s/pass\n'
+                % (name, result['status'], result['passes'],
+                   result['median_time'],
+                   result['pass_time']))
+            out.flush()
+
+    return {
+        'settings': dict(settings, repeat=repeat, passes_only=True),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def run_benchmarks(filenames, settings, repeat=5, timeout=60, out=None,
+                   rule_stats=False):
+    '''
+    Benchmarks each of the puzzle files, and returns the results as a
+    dictionary that can be saved as JSON.  If out is specified, a line is
+    written to it as each puzzle finishes.  If rule_stats is True, the
+    work done by each rule is counted as well (see bench_puzzle()).
+    '''
+    results = {}
+    for filename in filenames:
+        result = bench_puzzle(filename, settings, repeat, timeout, rule_stats)
+        name = os.path.basename(filename)
+        results[name] = result
+        if out is not None:
+            out.write('%-22s %-8s %9.4f s  %9.4f s  %7d nodes  %7d passes\n'
+                % (name, result['status'], result['median_time'],
+                   result['p95_time'], result['nodes'], result['passes']))
+            out.flush()
+
+    return {
+        'settings': dict(settings, repeat=repeat, timeout=timeout),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def rule_stats_by_kind(results):
+    '''
+    Totals up the rule counts of the puzzles in a set of benchmark results
+    by the size and difficulty of the puzzles, and returns a dictionary
+    mapping each (size, difficulty) to a RuleStats object.
+    '''
+    totals = {}
+    for (name, result) in sorted(results['results'].items()):
+        if 'rules' not in result:
+            continue
+
+        stats = totals.setdefault(puzzle_kind(name), slsolve.RuleStats())
+        for (rule, counts) in result['rules'].items():
+            stats.add(rule, counts['calls'], counts['time'],
+                      counts['positions'], counts['edges'])
+
+    return totals
+
+
+def compare_results(old, new, threshold):
+    '''
+    Compares two sets of benchmark results, and returns a list of
+    messages describing the regressions:  puzzles that stopped being
+    solved, or whose median time or node count went up by more than
+    threshold percent.  The times and node counts of runs that timed out
+    only show how far the search got, so they aren't compared.
+    '''
+    regressions = []
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        after = new['results'][name]
+
+        if before['status'] == 'solved' and after['status'] != 'solved':
+            regressions.append('%s:  was solved, now %s' %
+                               (name, after['status']))
+            continue
+
+        if 'timeout' in [before['status'], after['status']]:
+            continue
+
+        for key in ['median_time', 'nodes', 'pass_time']:
+            if before.get(key, 0) > 0 and key in after:
+                change = 100.0 * (after[key] - before[key]) / before[key]
+                if change > threshold:
+                    regressions.append('%s:  %s went from %s to %s (+%.1f%%)'
+                        % (name, key, before[key], after[key], change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the solver on a set of puzzles.')
+    parser.add_argument('paths', nargs='*', default=['puzzles'],
+        help='puzzle files, directories or glob patterns (default: the ' +
+             'puzzles folder)')
+    parser.add_argument('--size', action='append',
+        help='only run puzzles of this size, e.g. 10x10; may be repeated')
+    parser.add_argument('--difficulty', action='append',
+        help='only run puzzles of this difficulty, e.g. hard; may be ' +
+             'repeated')
+    parser.add_argument('--repeat', type=slsolve.positive_int, default=5,
+        help='the number of times to solve each puzzle (default 5)')
+    parser.add_argument('--timeout', type=float, default=60,
+        help='the number of seconds after which a run is given up on ' +
+             '(default 60)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='rules',
+        help="the solver to benchmark:  'rules' for the rules and search " +
+             "(the default), or 'sat' for the SAT engine")
+    parser.add_argument('--heuristic',
+        choices=sorted(slsolve.BRANCHING_HEURISTICS), default='constrained',
+        help='how the depth-first search picks the edge to branch on')
+    parser.add_argument('--seed', type=int,
+        help='seed for the random choices made during the search; by ' +
+             'default the search makes no random choices')
+    parser.add_argument('--sweep', action='store_true',
+        help='apply the rules by sweeping the whole board on every pass')
+    parser.add_argument('--passes-only', action='store_true',
+        help="only time the rules on each puzzle's starting board, " +
+             'without searching, and report the time per pass')
+    parser.add_argument('--rule-stats', action='store_true',
+        help='solve each puzzle once more counting the work done by each ' +
+             'rule, and report the totals for each size and difficulty')
+    parser.add_argument('--output',
+        help='save the results to this JSON file')
+    parser.add_argument('--baseline',
+        help='compare the results with those saved in this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two saved JSON files instead of running anything')
+    parser.add_argument('--threshold', type=float, default=10,
+        help='the increase in percent that counts as a regression ' +
+             '(default 10)')
+
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        (old_file, new_file) = args.compare
+        with open(old_file) as f:
+            baseline = json.load(f)
+        with open(new_file) as f:
+            results = json.load(f)
+
+    else:
+        baseline = None
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+
+        if args.engine == 'sat':
+            if args.passes_only:
+                parser.error('--passes-only only applies to the rules')
+            if args.rule_stats:
+                parser.error('--rule-stats only applies to the rules')
+            settings = {'engine': 'sat'}
+        else:
+            settings = {
+                'engine': 'rules',
+                'worklist': not args.sweep,
+                'heuristic': args.heuristic,
+                'seed': args.seed,
+            }
+        filenames = select_puzzles(iter_puzzle_files(args.paths),
+                                   args.size, args.difficulty)
+        if args.passes_only:
+            results = run_pass_benchmarks(filenames, settings, args.repeat,
+                                          sys.stdout, args.rule_stats)
+        else:
+            results = run_benchmarks(filenames, settings, args.repeat,
+                                     args.timeout, sys.stdout,
+                                     args.rule_stats)
+
+        totals = rule_stats_by_kind(results)
+        for ((size, difficulty), stats) in sorted(totals.items(),
+                key=lambda item: [str(part) for part in item[0]]):
+            print()
+            print('Rules for %s %s puzzles:' % (size or 'other',
+                                                 difficulty or ''))
+            print(stats.report())
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write('\n')
+
+    if baseline is not None:
+        regressions = compare_results(baseline, results, args.threshold)
+        for message in regressions:
+            print('REGRESSION  %s' % message)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print('No regressions above %g%%.' % args.threshold)
+
+
+if __name__ == '__main__':
+    main()
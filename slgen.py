@@ -0,0 +1,431 @@
+import argparse, os, random, sys, time
+from concurrent import futures
+
+import slsolve
+
+
+# The eight cells around a cell, in order going clockwise from the cell
+# above, as (row, col) offsets.  The orthogonal neighbors are at the even
+# positions, and the diagonal ones at the odd positions.
+RING = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+# The chance that random_loop() adds a cell next to more than one cell of
+# the region.  Cells next to just one are always added, so the region
+# grows as thin branches that the loop winds around, rather than as a
+# round blob with a short loop and large areas of 0s.
+THICKEN = 0.1
+
+
+class NodeBudget:
+    '''
+    A stop signal for count_solutions() that is set once the search has
+    expanded the specified number of nodes, as counted by the SearchStats
+    object passed to the search.  Like a Deadline (see slbatch.py), it is
+    only checked now and then, so the search can run a little past it.
+    '''
+
+    def __init__(self, stats, nodes):
+        self.stats = stats
+        self.nodes = nodes
+
+    def is_set(self):
+        return self.stats.nodes >= self.nodes
+
+
+def can_grow(inside, i, offsets):
+    '''
+    Reports whether the cell at index i can be added to the region of
+    inside cells without spoiling its border as a single loop.  The cells
+    around it must hold exactly one run of inside cells, so that the
+    region stays in one piece and doesn't close around a hole, and no
+    inside cell may touch the new cell only at a corner, since the loop
+    would then have to cross itself at that corner.
+    '''
+    ring = [inside[i + d] for d in offsets]
+
+    for k in range(1, 8, 2):
+        if ring[k] and not ring[k - 1] and not ring[(k + 1) % 8]:
+            return False
+
+    runs = 0
+    for k in range(8):
+        if ring[k] and not ring[k - 1]:
+            runs += 1
+    return runs == 1
+
+
+def random_loop(rows, cols, rng, fill=0.5):
+    '''
+    Picks a random region of cells whose border is a single loop, by
+    growing it one cell at a time from a random cell (see THICKEN), and
+    returns it as a bytearray with a 1 for each cell inside the loop.  The
+    cells are numbered row by row with a frame of outside cells around the
+    board, so cell (r, c) is at index (r + 1) * (cols + 2) + c + 1.  The
+    region grows until it covers the fraction fill of the board, or until
+    no more cells can be added.
+    '''
+    width = cols + 2
+    inside = bytearray(width * (rows + 2))
+    offsets = [dr * width + dc for (dr, dc) in RING]
+    sides = offsets[0::2]
+
+    on_board = bytearray(len(inside))
+    for r in range(1, rows + 1):
+        on_board[r * width + 1:r * width + cols + 1] = b'\x01' * cols
+
+    start = (rng.randrange(rows) + 1) * width + rng.randrange(cols) + 1
+    inside[start] = 1
+    size = 1
+    target = round(fill * rows * cols)
+
+    # The cells next to the region, picked from at random.  Cells that
+    # can't be added yet are dropped, and come back if a neighbor of
+    # theirs is added later.
+    frontier = [start + d for d in sides]
+    while size < target and len(frontier) > 0:
+        k = rng.randrange(len(frontier))
+        i = frontier[k]
+        frontier[k] = frontier[-1]
+        frontier.pop()
+
+        if inside[i] or not on_board[i] or not can_grow(inside, i, offsets):
+            continue
+        if sum(inside[i + d] for d in sides) > 1 and rng.random() >= THICKEN:
+            continue
+
+        inside[i] = 1
+        size += 1
+        frontier.extend(i + d for d in sides)
+
+    return inside
+
+
+def loop_clues(rows, cols, inside):
+    '''
+    Returns the clues of every cell for the loop around the region of
+    inside cells from random_loop(), in the form that Puzzle() takes:  a
+    list of rows strings of cols characters each.  A cell's clue is the
+    number of its sides that the loop runs along, which are the sides
+    between it and a neighbor on the other side of the loop.
+    '''
+    width = cols + 2
+    cell_values = []
+    for r in range(1, rows + 1):
+        row = []
+        for i in range(r * width + 1, r * width + cols + 1):
+            links = 0
+            for d in (-width, -1, 1, width):
+                if inside[i] != inside[i + d]:
+                    links += 1
+            row.append(str(links))
+        cell_values.append(''.join(row))
+
+    return cell_values
+
+
+def rules_solve(p, clues):
+    '''
+    Adds the clues, a list of (row, col, value) tuples, to the puzzle and
+    applies the rules, and then backs the puzzle out to where it was.
+    Returns True if the rules alone solved the puzzle, which since they
+    never guess means that the puzzle's solution is unique.
+    '''
+    mark = p.checkpoint()
+    try:
+        for (r, c, value) in clues:
+            p.add_clue(r, c, value)
+        p.iter_solve()
+        return p.is_solved()
+    finally:
+        p.undo(mark)
+
+
+def remove_clues(rows, cols, cell_values, rng, max_checks=100):
+    '''
+    Removes clues from the fully clued puzzle for as long as the rules
+    alone can still solve it, going through the clues in the reverse of a
+    random order.  Returns (cell_values, checks):  the clues that are left,
+    and the number of clues that were tested by running the rules.  If the
+    rules can't solve even the fully clued puzzle, returns None.
+
+    Running the rules from scratch for every clue would be slow, so they
+    are run on a single board instead.  First the clues are added to the
+    board in order, with a checkpoint before each one, until the rules
+    solve it.  Clues in cells that the rules have already filled in are
+    left out, and so are all the clues after the one that finished the
+    board; the clues that were added are enough to solve it, so the rest
+    can go without testing.  Then each clue that was added is tested, starting from the
+    last, by undoing the board to the checkpoint just before it, adding
+    the clues that had to be kept, and seeing whether the rules can still
+    solve the board.  Adding clues never undoes what the rules worked out
+    from the earlier ones, so this reaches the same board as running the
+    rules from scratch.
+
+    The tests get slower as they go, since the board is undone further
+    each time, but they also find fewer clues to remove.  Once max_checks
+    clues have been tested the rest are kept, which leaves a few more
+    clues than are needed in a fraction of the time.
+    '''
+    p = slsolve.Puzzle(rows, cols, [' ' * cols] * rows)
+    p.start_trail()
+    p.iter_solve()
+
+    order = [(2 * r + 2, 2 * c + 2, cell_values[r][c])
+             for r in range(rows) for c in range(cols)
+             if cell_values[r][c] != ' ']
+    rng.shuffle(order)
+
+    added = []
+    marks = []
+    for (r, c, value) in order:
+        cell = p.cell_index(r, c)
+        if p.cell_links[cell] + p.cell_xes[cell] == 4:
+            continue
+
+        marks.append(p.checkpoint())
+        added.append((r, c, value))
+        p.add_clue(r, c, value)
+        p.iter_solve()
+        if p.is_solved():
+            break
+    else:
+        return None
+
+    kept = []
+    checks = 0
+    for i in range(len(added) - 1, -1, -1):
+        if checks == max_checks:
+            kept.extend(added[:i + 1])
+            break
+
+        p.undo(marks[i])
+        checks += 1
+        if not rules_solve(p, kept):
+            kept.append(added[i])
+
+    rows_left = [[' '] * cols for r in range(rows)]
+    for (r, c, value) in kept:
+        rows_left[r // 2 - 1][c // 2 - 1] = value
+
+    return ([''.join(row) for row in rows_left], checks)
+
+
+def is_unique(rows, cols, cell_values, node_limit):
+    '''
+    Reports whether the search can show that the puzzle has exactly one
+    solution within node_limit search nodes.
+    '''
+    p = slsolve.Puzzle(rows, cols, cell_values)
+    stats = slsolve.SearchStats()
+    count = slsolve.count_solutions(p, 2, stats=stats,
+                                    stop=NodeBudget(stats, node_limit))
+    return count == 1
+
+
+def remove_clues_by_search(rows, cols, cell_values, rng, attempts=20,
+                           node_limit=200):
+    '''
+    Tries to remove clues that remove_clues() left behind, using the search
+    rather than the rules alone to check that the solution stays unique.
+    Since remove_clues() only leaves clues that the rules need, every clue
+    removed here makes the puzzle hard.  Up to attempts clues are tried,
+    picked at random, and a clue is only removed if uniqueness can be
+    shown within node_limit search nodes, which also limits how hard the
+    puzzle gets.  Returns (cell_values, checks) as remove_clues() does.
+    '''
+    cells = [(r, c) for r in range(rows) for c in range(cols)
+             if cell_values[r][c] != ' ']
+    rng.shuffle(cells)
+
+    checks = 0
+    for (r, c) in cells[:attempts]:
+        trial = list(cell_values)
+        trial[r] = trial[r][:c] + ' ' + trial[r][c + 1:]
+        checks += 1
+        if is_unique(rows, cols, trial, node_limit):
+            cell_values = trial
+
+    return (cell_values, checks)
+
+
+def grade_puzzle(rows, cols, cell_values):
+    '''
+    Solves the puzzle, and returns (grade, nodes), where grade is 'normal'
+    if the rules solve it without any search, as for the puzzles in the
+    puzzles folder, or 'hard' if they don't, and nodes is the number of
+    nodes that the depth-first search expanded.
+    '''
+    p = slsolve.Puzzle(rows, cols, cell_values)
+    stats = slsolve.SearchStats()
+    slsolve.solve_puzzle(p, stats=stats)
+    if stats.nodes == 1:
+        return ('normal', 1)
+    return ('hard', stats.nodes)
+
+
+def generate_puzzle(rows, cols, seed, difficulty='normal', fill=0.5,
+                    max_checks=100, attempts=20, node_limit=200):
+    '''
+    Generates a puzzle with a unique solution from a random loop, and
+    returns a dictionary describing it.  The random choices are made with
+    a random number generator seeded from seed, so the same seed gives the
+    same puzzle.  The clues are removed with remove_clues(), testing up to
+    max_checks of them.  If difficulty is 'hard', the puzzle is then made
+    hard with remove_clues_by_search(), which isn't always possible; the
+    grade in the result says what the puzzle turned out to be.
+    '''
+    rng = random.Random(seed)
+    start = time.perf_counter()
+
+    # The rules nearly always solve a fully clued board; if they don't,
+    # no clues can be removed with them, so another loop is tried.
+    loops = 0
+    result = None
+    while result is None:
+        loops += 1
+        inside = random_loop(rows, cols, rng, fill)
+        result = remove_clues(rows, cols, loop_clues(rows, cols, inside), rng,
+                              max_checks)
+
+    (cell_values, checks) = result
+    if difficulty == 'hard':
+        (cell_values, hard_checks) = remove_clues_by_search(rows, cols,
+            cell_values, rng, attempts, node_limit)
+        checks += hard_checks
+
+    (grade, nodes) = grade_puzzle(rows, cols, cell_values)
+
+    return {
+        'seed': seed,
+        'rows': rows,
+        'cols': cols,
+        'cell_values': cell_values,
+        'grade': grade,
+        'nodes': nodes,
+        'clues': sum(len(row) - row.count(' ') for row in cell_values),
+        'loops': loops,
+        'checks': checks,
+        'time': round(time.perf_counter() - start, 4),
+    }
+
+
+def generate_task(task):
+    '''
+    Generates one puzzle in a worker process.  The task is a tuple (rows,
+    cols, seed, settings), where settings holds the keyword arguments for
+    generate_puzzle().
+    '''
+    (rows, cols, seed, settings) = task
+    return generate_puzzle(rows, cols, seed, **settings)
+
+
+def parse_size(text):
+    '''
+    Parses a puzzle size such as 25x30, given as the number of columns by
+    the number of rows like the names of the puzzle files, for argparse.
+    Returns (rows, cols).
+    '''
+    try:
+        (cols, rows) = [int(n) for n in text.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % text)
+    if rows < 2 or cols < 2:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % text)
+    return (rows, cols)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generates Slitherlink puzzles with unique solutions.')
+    parser.add_argument('--size', type=parse_size, default=(10, 10),
+        help='the size of the puzzles, as columns x rows (default 10x10)')
+    parser.add_argument('--count', type=slsolve.positive_int, default=1,
+        help='the number of puzzles to generate (default 1)')
+    parser.add_argument('--difficulty', choices=['normal', 'hard'],
+        default='normal',
+        help="'normal' for puzzles that the rules solve alone (the " +
+             "default), or 'hard' to go on removing clues as long as a " +
+             'short search can show that the solution is unique')
+    parser.add_argument('--fill', type=float, default=0.5,
+        help='the fraction of the board inside the loop (default 0.5)')
+    parser.add_argument('--checks', type=slsolve.positive_int, default=100,
+        help='the number of clues to test for removal with the rules ' +
+             '(default 100); testing more gives puzzles with fewer clues, ' +
+             'but takes longer')
+    parser.add_argument('--attempts', type=slsolve.positive_int, default=20,
+        help='the number of extra clues to try removing for hard ' +
+             'puzzles (default 20)')
+    parser.add_argument('--node-limit', type=slsolve.positive_int,
+        default=200,
+        help='the number of search nodes in which a hard puzzle must be ' +
+             'shown to be unique (default 200)')
+    parser.add_argument('--seed', type=int,
+        help='the seed of the first puzzle, which is increased by 1 for ' +
+             'each puzzle after it (default: random)')
+    parser.add_argument('--jobs', type=slsolve.positive_int,
+        default=os.cpu_count() or 1,
+        help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--output-dir', default='.',
+        help='the folder to save the puzzles in (default: the current ' +
+             'folder)')
+    parser.add_argument('--output',
+        help='write all the puzzles to this one puzzle file, one after ' +
+             'the other, instead of a file each; a name ending in .gz ' +
+             'is compressed')
+
+    args = parser.parse_args()
+    if not 0 < args.fill < 1:
+        parser.error('--fill must be between 0 and 1')
+
+    (rows, cols) = args.size
+    seed = args.seed
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+
+    settings = {
+        'difficulty': args.difficulty,
+        'fill': args.fill,
+        'max_checks': args.checks,
+        'attempts': args.attempts,
+        'node_limit': args.node_limit,
+    }
+    tasks = [(rows, cols, seed + n, settings) for n in range(args.count)]
+
+    if args.output is None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        output = None
+    else:
+        output = slsolve.PuzzleWriter(args.output)
+
+    # If the puzzles go to standard output, the progress goes to stderr.
+    report = sys.stdout
+    if args.output == '-':
+        report = sys.stderr
+
+    start = time.perf_counter()
+    with futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for result in executor.map(generate_task, tasks):
+            name = '%dx%d_%s_%d' % (cols, rows, result['grade'],
+                                    result['seed'])
+            if output is not None:
+                output.write(rows, cols, result['cell_values'], name)
+            else:
+                name += '.txt'
+                with slsolve.PuzzleWriter(os.path.join(args.output_dir,
+                                                       name)) as f:
+                    f.write(rows, cols, result['cell_values'])
+            print('%-28s %4d clues  %6d nodes  %5d checks  %8.3f s' %
+                  (name, result['clues'], result['nodes'], result['checks'],
+                   result['time']), file=report)
+            report.flush()
+
+    if output is not None:
+        output.close()
+
+    elapsed = time.perf_counter() - start
+    print('Generated %d puzzles in %.1f s (%.1f per minute).' %
+          (args.count, elapsed, 60 * args.count / elapsed), file=report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,567 @@
+import argparse, heapq, itertools, logging, sys
+
+import slsolve
+
+try:
+    import pycosat
+except ImportError:
+    # pycosat is optional; without it the built-in solver is used.
+    pycosat = None
+
+
+# The SAT engine reports its progress through this logger, in the same way
+# that the rules and search report through the slsolve logger.
+log = logging.getLogger('slsat')
+
+
+class SatSolver:
+    '''
+    A small CDCL (conflict-driven clause learning) SAT solver, so that the
+    SAT engine works without any other packages installed.  Variables are
+    numbered from 1, and clauses are lists of non-zero integers as in the
+    DIMACS format:  v for variable v being true, and -v for it being
+    false.
+
+    The solver is incremental:  clauses can be added after solve() has
+    returned, and the clauses it learned from earlier calls are kept,
+    since adding clauses never makes a learned clause invalid.
+
+    Internally a literal is numbered 2 * v for v and 2 * v + 1 for -v, so
+    that the opposite of literal l is l ^ 1.  Each clause watches its first
+    two literals, and is only looked at when one of those becomes false.
+    '''
+
+    def __init__(self, num_vars):
+        self.num_vars = num_vars
+
+        # The value of each literal:  1 if true, -1 if false, 0 if the
+        # variable is unassigned.  Both literals of a variable are kept
+        # up to date, so a literal's value is a single lookup.
+        self.values = [0] * (2 * num_vars + 2)
+        self.watches = [[] for i in range(2 * num_vars + 2)]
+
+        # For each variable, the decision level it was assigned at, the
+        # clause that implied it (None for decisions), its activity for
+        # picking decisions, and the polarity it last had.
+        self.levels = [0] * (num_vars + 1)
+        self.reasons = [None] * (num_vars + 1)
+        self.activity = [0.0] * (num_vars + 1)
+        self.activity_inc = 1.0
+        self.phases = [1] * (num_vars + 1)
+
+        # The assigned literals in order, and the position in the trail
+        # where each decision level starts.  The literals before qhead
+        # have had their consequences propagated.
+        self.trail = []
+        self.trail_limits = []
+        self.qhead = 0
+
+        # Unassigned variables by activity.  Entries go stale when the
+        # variable is assigned or its activity changes, and are skipped
+        # when they come up.
+        self.order = [(0.0, v) for v in range(1, num_vars + 1)]
+
+        self.unsatisfiable = False
+        self.model = None
+        self.decisions = 0
+        self.conflicts = 0
+        self.max_level = 0
+
+    def add_clause(self, clause):
+        '''
+        Adds a clause, given as a list of DIMACS literals.  This undoes any
+        assignment left over from the last call to solve().
+        '''
+        self.backtrack(0)
+
+        lits = []
+        for x in clause:
+            lit = 2 * abs(x) + (x < 0)
+            value = self.values[lit]
+            if value == 1 and self.levels[lit >> 1] == 0:
+                # The clause is already satisfied for good.
+                return
+            if value == -1 and self.levels[lit >> 1] == 0:
+                continue
+            if lit not in lits:
+                lits.append(lit)
+
+        if len(lits) == 0:
+            self.unsatisfiable = True
+        elif len(lits) == 1:
+            if self.values[lits[0]] == 0:
+                self.assign(lits[0], None)
+        else:
+            self.watches[lits[0]].append(lits)
+            self.watches[lits[1]].append(lits)
+
+    def assign(self, lit, reason):
+        var = lit >> 1
+        self.values[lit] = 1
+        self.values[lit ^ 1] = -1
+        self.levels[var] = len(self.trail_limits)
+        self.reasons[var] = reason
+        self.trail.append(lit)
+
+    def propagate(self):
+        '''
+        Assigns every literal implied by the assignments on the trail.
+        Returns the clause that became false if there is a conflict, or
+        None otherwise.
+        '''
+        values = self.values
+        watches = self.watches
+        trail = self.trail
+
+        while self.qhead < len(trail):
+            false_lit = trail[self.qhead] ^ 1
+            self.qhead += 1
+
+            watchers = watches[false_lit]
+            watches[false_lit] = kept = []
+            for (i, clause) in enumerate(watchers):
+                # Keep the false literal in the second slot.
+                if clause[0] == false_lit:
+                    clause[0] = clause[1]
+                    clause[1] = false_lit
+
+                first = clause[0]
+                if values[first] == 1:
+                    kept.append(clause)
+                    continue
+
+                # Look for another literal to watch.
+                for k in range(2, len(clause)):
+                    if values[clause[k]] != -1:
+                        clause[1] = clause[k]
+                        clause[k] = false_lit
+                        watches[clause[1]].append(clause)
+                        break
+                else:
+                    kept.append(clause)
+                    if values[first] == -1:
+                        kept.extend(watchers[i + 1:])
+                        self.qhead = len(trail)
+                        return clause
+                    self.assign(first, clause)
+
+        return None
+
+    def analyze(self, conflict):
+        '''
+        Works out the clause to learn from a conflict, cutting the
+        implication graph at the first unique implication point.  Returns
+        the learned clause, with the literal to assert first, and the level
+        to go back to.
+        '''
+        levels = self.levels
+        level = len(self.trail_limits)
+        seen = set()
+        learned = [None]
+        count = 0
+        index = len(self.trail) - 1
+        lit = None
+        clause = conflict
+
+        while True:
+            for q in (clause if lit is None else clause[1:]):
+                var = q >> 1
+                if var not in seen and levels[var] > 0:
+                    seen.add(var)
+                    self.bump(var)
+                    if levels[var] >= level:
+                        count += 1
+                    else:
+                        learned.append(q)
+
+            # Go back along the trail to the next literal in the conflict.
+            while self.trail[index] >> 1 not in seen:
+                index -= 1
+            lit = self.trail[index]
+            index -= 1
+            clause = self.reasons[lit >> 1]
+            seen.discard(lit >> 1)
+            count -= 1
+            if count == 0:
+                break
+
+        learned[0] = lit ^ 1
+        if len(learned) == 1:
+            return (learned, 0)
+
+        # Watch the literal from the highest remaining level second, so
+        # that the clause is watched correctly after backtracking.
+        best = max(range(1, len(learned)), key=lambda i: levels[learned[i] >> 1])
+        (learned[1], learned[best]) = (learned[best], learned[1])
+        return (learned, levels[learned[1] >> 1])
+
+    def bump(self, var):
+        self.activity[var] += self.activity_inc
+        if self.activity[var] > 1e100:
+            # Scale every activity down, keeping their order.
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.activity_inc *= 1e-100
+            self.order = [(-self.activity[v], v)
+                          for v in range(1, self.num_vars + 1)
+                          if self.values[2 * v] == 0]
+            heapq.heapify(self.order)
+        elif self.values[2 * var] == 0:
+            heapq.heappush(self.order, (-self.activity[var], var))
+
+    def backtrack(self, level):
+        if len(self.trail_limits) <= level:
+            return
+
+        start = self.trail_limits[level]
+        for lit in self.trail[start:]:
+            var = lit >> 1
+            self.values[lit] = 0
+            self.values[lit ^ 1] = 0
+            self.reasons[var] = None
+            self.phases[var] = lit & 1
+            heapq.heappush(self.order, (-self.activity[var], var))
+
+        del self.trail[start:]
+        del self.trail_limits[level:]
+        self.qhead = len(self.trail)
+
+    def pick_variable(self):
+        '''
+        Returns the unassigned variable with the highest activity, or None
+        if every variable is assigned.
+        '''
+        while self.order:
+            (activity, var) = heapq.heappop(self.order)
+            if self.values[2 * var] == 0 and -activity == self.activity[var]:
+                return var
+
+        for var in range(1, self.num_vars + 1):
+            if self.values[2 * var] == 0:
+                return var
+
+        return None
+
+    def solve(self, stop=None):
+        '''
+        Searches for an assignment that satisfies every clause.  Returns
+        True if one was found, leaving it in model as the set of true
+        variables; False if there is none; or None if stop was set first.
+        '''
+        self.model = None
+        if self.unsatisfiable:
+            return False
+
+        self.backtrack(0)
+        restarts = luby()
+        restart_limit = 100 * next(restarts)
+        conflicts = 0
+
+        while True:
+            conflict = self.propagate()
+            if conflict is not None:
+                self.conflicts += 1
+                conflicts += 1
+                if len(self.trail_limits) == 0:
+                    self.unsatisfiable = True
+                    return False
+
+                (learned, level) = self.analyze(conflict)
+                self.backtrack(level)
+                if len(learned) == 1:
+                    self.assign(learned[0], None)
+                else:
+                    self.watches[learned[0]].append(learned)
+                    self.watches[learned[1]].append(learned)
+                    self.assign(learned[0], learned)
+
+                self.activity_inc /= 0.95
+                continue
+
+            if conflicts >= restart_limit:
+                self.backtrack(0)
+                conflicts = 0
+                restart_limit = 100 * next(restarts)
+
+            if stop is not None and self.decisions % 256 == 0 and \
+               stop.is_set():
+                self.backtrack(0)
+                return None
+
+            var = self.pick_variable()
+            if var is None:
+                self.model = set(lit >> 1 for lit in self.trail
+                                 if lit & 1 == 0)
+                return True
+
+            self.decisions += 1
+            self.trail_limits.append(len(self.trail))
+            self.max_level = max(self.max_level, len(self.trail_limits))
+            self.assign(2 * var + self.phases[var], None)
+
+
+def luby():
+    '''
+    Generates the Luby sequence 1, 1, 2, 1, 1, 2, 4, 1, ..., which sets
+    the number of conflicts between restarts.
+    '''
+    for i in itertools.count(1):
+        # Find the k with 2^(k-1) <= i < 2^k, then either i ends a block
+        # of size 2^k - 1, or it repeats an earlier part of the sequence.
+        k = i.bit_length()
+        while i != (1 << k) - 1:
+            i -= (1 << (k - 1)) - 1
+            k = i.bit_length()
+        yield 1 << (k - 1)
+
+
+def edge_variable(tables, index):
+    '''
+    Returns the SAT variable for the edge at the specified board index.
+    Edge ID n is variable n + 1, and a variable is true when its edge is a
+    link.
+    '''
+    return tables.edge_ids[index] + 1
+
+
+def encode_puzzle(p):
+    '''
+    Encodes the rules of the puzzle as CNF clauses over one variable per
+    edge (see edge_variable()), and returns the number of variables and
+    the list of clauses.  Each numbered cell must have exactly that many
+    links around it, each dot must have zero or two links, and there must
+    be at least one link.  Edges already set on the board are fixed.
+
+    These clauses still allow several separate loops; solve_puzzle_sat()
+    rules those out as they come up.
+    '''
+    tables = p.tables
+    num_vars = len(tables.edge_positions)
+    clauses = [list(range(1, num_vars + 1))]
+
+    for cell in range(p.rows * p.cols):
+        value = p.clues[cell]
+        if value == slsolve.BLANK_CODE:
+            continue
+
+        required = value - slsolve.ZERO_CODE
+        edges = [edge_variable(tables, i)
+                 for i in tables.cell_edges[4 * cell:4 * cell + 4]]
+
+        # At most required links:  no required + 1 edges are all links.
+        for subset in itertools.combinations(edges, required + 1):
+            clauses.append([-v for v in subset])
+
+        # At least required links:  no 5 - required edges are all x-es.
+        for subset in itertools.combinations(edges, 5 - required):
+            clauses.append(list(subset))
+
+    for dot in range((p.rows + 1) * (p.cols + 1)):
+        edges = [edge_variable(tables, i)
+                 for i in tables.dot_edges[4 * dot:4 * dot + 4]
+                 if tables.edge_ids[i] >= 0]
+
+        # A link into the dot must have another link to leave by...
+        for v in edges:
+            clauses.append([-v] + [u for u in edges if u != v])
+
+        # ...and no dot can have three links.
+        for subset in itertools.combinations(edges, 3):
+            clauses.append([-v for v in subset])
+
+    for (edge, index) in enumerate(tables.edge_positions):
+        value = p.board[index]
+        if value == slsolve.X_CODE:
+            clauses.append([-(edge + 1)])
+        elif value in slsolve.LINK_CODES:
+            clauses.append([edge + 1])
+
+    return (num_vars, clauses)
+
+
+def find_loops(p, model):
+    '''
+    Returns the loops formed by the links in a model, as lists of edge
+    variables.  Every dot in the model has zero or two links, so the
+    links always split up into closed loops.
+    '''
+    tables = p.tables
+    links_at = {}
+    for v in model:
+        for dot in tables.edge_dots[2 * (v - 1):2 * v]:
+            links_at.setdefault(dot, []).append(v)
+
+    loops = []
+    done = set()
+    for start in sorted(model):
+        if start in done:
+            continue
+
+        loop = []
+        v = start
+        dot = tables.edge_dots[2 * (v - 1)]
+        while v not in done:
+            done.add(v)
+            loop.append(v)
+            # Step to the far end of this link, and take the other link
+            # out of that dot.
+            ends = tables.edge_dots[2 * (v - 1):2 * v]
+            dot = ends[1] if ends[0] == dot else ends[0]
+            (a, b) = links_at[dot]
+            v = b if a == v else a
+
+        loops.append(loop)
+
+    return loops
+
+
+def loop_cuts(loops):
+    '''
+    Returns the clauses that rule out the separate loops of a model.  Once
+    every link of a loop is in place its dots are full, so that loop would
+    have to be the whole solution:  no link outside it can be in place as
+    well.  For each loop, this adds the clause that the loop is incomplete
+    or some link of the next loop is missing.
+    '''
+    cuts = []
+    for (i, loop) in enumerate(loops):
+        other = loops[(i + 1) % len(loops)]
+        cuts.append([-v for v in loop] + [-other[0]])
+
+    return cuts
+
+
+def apply_model(p, model):
+    '''
+    Sets every unknown edge on the board from a model:  the edges whose
+    variables are true become links, and the rest become x-es.
+    '''
+    for (edge, index) in enumerate(p.tables.edge_positions):
+        (r, c) = divmod(index, p.board_width)
+        if edge + 1 not in model:
+            p.cond_set_x(r, c)
+        elif r % 2 == 1:
+            p.cond_set_link(r, c, '-')
+        else:
+            p.cond_set_link(r, c, '|')
+
+
+def solve_puzzle_sat(p, solver='auto', stats=None, stop=None,
+                     listener=None):
+    '''
+    Solves the puzzle with a SAT solver instead of the rules and search of
+    slsolve.solve_puzzle().  The puzzle's clues and the edges already set
+    on its board are encoded with encode_puzzle() and solved; whenever the
+    model found has more than one loop, clauses ruling those loops out are
+    added and the solver is run again.
+
+    The solver argument is 'builtin' for SatSolver, 'pycosat' for pycosat,
+    or 'auto' to use pycosat if it is installed.  The stats, stop and
+    listener arguments are the same as for slsolve.solve_puzzle(); the
+    solver's decisions are counted as search nodes.  Returns True if the
+    puzzle was solved, leaving the solution on the puzzle.
+    '''
+    if solver == 'auto':
+        solver = 'pycosat' if pycosat is not None else 'builtin'
+    if solver == 'pycosat' and pycosat is None:
+        raise ValueError("pycosat is not installed")
+
+    if stats is None:
+        stats = slsolve.SearchStats(listener)
+    elif listener is not None:
+        stats.listener = listener
+
+    (num_vars, clauses) = encode_puzzle(p)
+    log.info("Encoded %d edges as %d clauses.", num_vars, len(clauses))
+
+    if solver == 'builtin':
+        sat = SatSolver(num_vars)
+        for clause in clauses:
+            sat.add_clause(clause)
+
+    rounds = 0
+    while True:
+        rounds += 1
+        if solver == 'builtin':
+            result = sat.solve(stop)
+            model = sat.model
+        else:
+            # pycosat isn't incremental, so it starts over with the cuts
+            # added so far.  It also can't be stopped part way.
+            solution = pycosat.solve(clauses)
+            result = solution != 'UNSAT'
+            model = None
+            if result:
+                model = set(v for v in solution if v > 0)
+
+        if result is None:
+            log.info("Stopped after %d rounds.", rounds)
+            break
+
+        if not result:
+            log.info("Couldn't solve puzzle:  no assignment after %d rounds.",
+                     rounds)
+            break
+
+        loops = find_loops(p, model)
+        log.debug("Round %d:  %d loops.", rounds, len(loops))
+        if len(loops) == 1:
+            apply_model(p, model)
+            break
+
+        cuts = loop_cuts(loops)
+        clauses.extend(cuts)
+        if solver == 'builtin':
+            for clause in cuts:
+                sat.add_clause(clause)
+
+        if stop is not None and stop.is_set():
+            result = None
+            break
+
+    if solver == 'builtin':
+        stats.merge(sat.decisions, sat.max_level)
+        log.info("%d rounds, %d decisions, %d conflicts.", rounds,
+                 sat.decisions, sat.conflicts)
+
+    if result and p.is_solved():
+        stats.event('solved', depth=None, nodes=stats.nodes)
+        return True
+
+    stats.event('failed', nodes=stats.nodes)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Solves a Slitherlink puzzle with a SAT solver.')
+    parser.add_argument('filename', help='the puzzle file to solve')
+    parser.add_argument('--solver', choices=['auto', 'builtin', 'pycosat'],
+        default='auto',
+        help="the SAT solver to use; 'auto' (the default) uses pycosat " +
+             'if it is installed, and the built-in solver otherwise')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='report every round of loop cuts')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='only print the solution')
+
+    args = parser.parse_args()
+    if args.solver == 'pycosat' and pycosat is None:
+        parser.error('pycosat is not installed')
+
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logging.basicConfig(format='%(message)s', level=level, stream=sys.stdout)
+
+    p = slsolve.load_puzzle(args.filename)
+    if not args.quiet:
+        p.pretty_print()
+    if solve_puzzle_sat(p, solver=args.solver):
+        p.pretty_print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,48 @@
-import copy, sys, random
+import argparse, copy, gzip, logging, mmap, multiprocessing, random, sys, time
+from concurrent import futures
+from array import array
+from collections import OrderedDict, deque
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is only needed for the vectorized rules (see
+    # apply_vectorized_rules()), which fall back to the ordinary rules
+    # without it.
+    numpy = None
+
+
+# The solver reports its progress through this logger, which is silent
+# unless the application configures logging.  The outcome of a search is
+# logged at INFO, each search node at DEBUG, and the work done by the
+# rules at TRACE, which is finer-grained than DEBUG.
+log = logging.getLogger('slsolve')
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+
+# The board is a bytearray, and the rules compare its bytes against these
+# codes directly rather than converting each byte to a string.
+BLANK_CODE = ord(' ')
+DOT_CODE = ord('.')
+X_CODE = ord('x')
+H_LINK_CODE = ord('-')
+V_LINK_CODE = ord('|')
+LINK_CODES = (H_LINK_CODE, V_LINK_CODE)
+
+# The code of a numbered cell is ZERO_CODE plus its number.
+ZERO_CODE = ord('0')
+ONE_CODE = ord('1')
+TWO_CODE = ord('2')
+THREE_CODE = ord('3')
+
+# If this is True, get_board() and set_board() check that the position
+# they are given is on the board, and cond_set_link() checks that the link
+# fits the position.  The rules index the board directly and rely on the
+# frame of '#' and 'x' around it, so this is only useful for debugging
+# (see the --check-bounds option).
+CHECK_BOUNDS = False
 
 
 class MoveError(Exception):
@@ -21,12 +65,13 @@ def cellfunc_fill_in_xes(puzzle, row, col):
     on it, the remaining slots are set to 'x'.
     '''
 
-    cellval = puzzle.get_board(row, col)
-    if cellval != ' ':
-        links_required = int(cellval)
+    cellval = puzzle.board[row * puzzle.board_width + col]
+    if cellval != BLANK_CODE:
+        links_required = cellval - ZERO_CODE
 
-        num_links = puzzle.count_adjacent_links(row, col)
-        num_xes = puzzle.count_adjacent_xes(row, col)
+        cell = puzzle.cell_index(row, col)
+        num_links = puzzle.cell_links[cell]
+        num_xes = puzzle.cell_xes[cell]
 
         if links_required == num_links and (num_links + num_xes) != 4:
             # Remaining empty slots are set to 'x'.
@@ -51,8 +96,9 @@ def dotfunc_fill_in_xes_links(puzzle, row, col):
     # If the dot has 3 x-es surrounding it, the final slot should be
     # set to 'x' too.
 
-    num_links = puzzle.count_adjacent_links(row, col)
-    num_xes = puzzle.count_adjacent_xes(row, col)
+    dot = puzzle.dot_index(row, col)
+    num_links = puzzle.dot_links[dot]
+    num_xes = puzzle.dot_xes[dot]
 
     if num_links == 2 and num_xes < 2:
         # The other two slots should be set to 'x'.
@@ -83,12 +129,13 @@ def cellfunc_fill_in_links(puzzle, row, col):
     In this case, the remaining slots must be links.
     '''
 
-    cellval = puzzle.get_board(row, col)
-    if cellval != ' ':
-        links_required = int(cellval)
+    cellval = puzzle.board[row * puzzle.board_width + col]
+    if cellval != BLANK_CODE:
+        links_required = cellval - ZERO_CODE
 
-        num_links = puzzle.count_adjacent_links(row, col)
-        num_xes = puzzle.count_adjacent_xes(row, col)
+        cell = puzzle.cell_index(row, col)
+        num_links = puzzle.cell_links[cell]
+        num_xes = puzzle.cell_xes[cell]
 
         if num_links < links_required and (4 - num_xes) == links_required:
             # Remaining empty slots are set to links!
@@ -106,7 +153,11 @@ def cellfunc_handle_adjacent_threes(puzzle, row, col):
     values, although we can't fully assign links.
     '''
 
-    if puzzle.get_board(row, col) != '3':
+    board = puzzle.board
+    width = puzzle.board_width
+    i = row * width + col
+
+    if board[i] != THREE_CODE:
         return
 
     prev_row = row - 2
@@ -114,30 +165,34 @@ def cellfunc_handle_adjacent_threes(puzzle, row, col):
     next_col = col + 2
 
     if next_row < puzzle.board_height and \
-       puzzle.get_board(next_row, col) == '3':
-        # This case handles two vertically adjacent '3' cells.
+       board[i + 2 * width] == THREE_CODE:
+        # This case handles two vertically adjacent '3' cells.  The one
+        # exception is a loop running just around the two cells, which has
+        # an 'x' between them; that is only possible if that loop is the
+        # whole solution.
 
-        puzzle.cond_set_link(row - 1, col, '-')
-        puzzle.cond_set_link(row + 1, col, '-')
-        puzzle.cond_set_link(row + 3, col, '-')
+        if not puzzle.is_lone_loop(row, col, next_row, col):
+            puzzle.cond_set_link(row - 1, col, '-')
+            puzzle.cond_set_link(row + 1, col, '-')
+            puzzle.cond_set_link(row + 3, col, '-')
 
-        puzzle.cond_set_x(row + 1, col - 2)
-        puzzle.cond_set_x(row + 1, col + 2)
+            puzzle.cond_set_x(row + 1, col - 2)
+            puzzle.cond_set_x(row + 1, col + 2)
 
-    elif next_col < puzzle.board_width and \
-         puzzle.get_board(row, next_col) == '3':
-        # This case handles two horizontally adjacent '3' cells.
+    elif next_col < width and board[i + 2] == THREE_CODE:
+        # This case handles two horizontally adjacent '3' cells, with the
+        # same exception.
 
-        puzzle.cond_set_link(row, col - 1, '|')
-        puzzle.cond_set_link(row, col + 1, '|')
-        puzzle.cond_set_link(row, col + 3, '|')
+        if not puzzle.is_lone_loop(row, col, row, next_col):
+            puzzle.cond_set_link(row, col - 1, '|')
+            puzzle.cond_set_link(row, col + 1, '|')
+            puzzle.cond_set_link(row, col + 3, '|')
 
-        puzzle.cond_set_x(row - 2, col + 1)
-        puzzle.cond_set_x(row + 2, col + 1)
+            puzzle.cond_set_x(row - 2, col + 1)
+            puzzle.cond_set_x(row + 2, col + 1)
 
-    elif next_row < puzzle.board_height and \
-         next_col < puzzle.board_width and \
-         puzzle.get_board(next_row, next_col) == '3':
+    elif next_row < puzzle.board_height and next_col < width and \
+         board[i + 2 * width + 2] == THREE_CODE:
 
         # This case handles a '3' cell with another one down and to the right.
 
@@ -147,8 +202,8 @@ def cellfunc_handle_adjacent_threes(puzzle, row, col):
         puzzle.cond_set_link(row + 2, col + 3, '|')
         puzzle.cond_set_link(row + 3, col + 2, '-')
 
-    elif prev_row >= 0 and next_col < puzzle.board_width and \
-         puzzle.get_board(prev_row, next_col) == '3':
+    elif prev_row >= 0 and next_col < width and \
+         board[i - 2 * width + 2] == THREE_CODE:
 
         # This case handles a '3' cell with another one up and to the right.
 
@@ -160,7 +215,11 @@ def cellfunc_handle_adjacent_threes(puzzle, row, col):
 
 
 def cellfunc_handle_diagonal_ones(puzzle, row, col):
-    if puzzle.get_board(row, col) != '1':
+    board = puzzle.board
+    width = puzzle.board_width
+    i = row * width + col
+
+    if board[i] != ONE_CODE:
         return
 
     for dr in [-1, 1]:
@@ -169,23 +228,22 @@ def cellfunc_handle_diagonal_ones(puzzle, row, col):
             next_col = col + 2 * dc
 
             if next_row < 0 or next_row >= puzzle.board_height or \
-               next_col < 0 or next_col >= puzzle.board_width:
+               next_col < 0 or next_col >= width:
                 # Went off the edge of the board.
                 continue
 
-            if puzzle.get_board(next_row, next_col) != '1':
+            next_i = next_row * width + next_col
+            if board[next_i] != ONE_CODE:
                 # Not a diagonal 1.  Skip.
                 continue
 
-            if puzzle.get_board(row, col - dc) == 'x' and \
-               puzzle.get_board(row - dr, col) == 'x':
+            if board[i - dc] == X_CODE and board[i - dr * width] == X_CODE:
                 # 'x' values on outer edges of 1-cell.  Put corresponding 'x'
                 # values on outer edges of adjacent diagonal 1-cell.
                 puzzle.cond_set_x(next_row, next_col + dc)
                 puzzle.cond_set_x(next_row + dr, next_col)
 
-            elif puzzle.get_board(row, col + dc) == 'x' and \
-                 puzzle.get_board(row + dr, col) == 'x':
+            elif board[i + dc] == X_CODE and board[i + dr * width] == X_CODE:
                 # 'x' values on inner edges of 1-cell.  Put corresponding 'x'
                 # values on inner edges of adjacent diagonal 1-cell.
                 puzzle.cond_set_x(next_row, next_col - dc)
@@ -198,7 +256,10 @@ def cellfunc_handle_diagonal_chains(puzzle, row, col):
     ends have '3' values, and intermediate values of '2' values, etc.
     '''
 
-    if puzzle.get_board(row, col) != '3':
+    board = puzzle.board
+    width = puzzle.board_width
+
+    if board[row * width + col] != THREE_CODE:
         return
 
     for dr in [-1, 1]:
@@ -210,11 +271,12 @@ def cellfunc_handle_diagonal_chains(puzzle, row, col):
                 next_col = col + 2 * dc * i
 
                 if next_row < 0 or next_row >= puzzle.board_height or \
-                   next_col < 0 or next_col >= puzzle.board_width:
+                   next_col < 0 or next_col >= width:
                     # Went off the edge of the board.  End of potential chain.
                     break
 
-                if puzzle.get_board(next_row, next_col) == '3':
+                next_i = next_row * width + next_col
+                if board[next_i] == THREE_CODE:
                     # This cell is at the end of a chain of 3/2*/3 values.
                     # Put links at both ends of the chains.
                     puzzle.cond_set_link(row, col - dc, '|')
@@ -223,11 +285,11 @@ def cellfunc_handle_diagonal_chains(puzzle, row, col):
                     puzzle.cond_set_link(next_row, next_col + dc, '|')
                     puzzle.cond_set_link(next_row + dr, next_col, '-')
 
-                elif puzzle.get_board(next_row, next_col) == '2':
-                    side1 = puzzle.get_board(next_row, next_col + dc)
-                    side2 = puzzle.get_board(next_row + dr, next_col)
-                    if (side1 in ['-', '|'] and side2 == 'x') or \
-                       (side2 in ['-', '|'] and side1 == 'x'):
+                elif board[next_i] == TWO_CODE:
+                    side1 = board[next_i + dc]
+                    side2 = board[next_i + dr * width]
+                    if (side1 in LINK_CODES and side2 == X_CODE) or \
+                       (side2 in LINK_CODES and side1 == X_CODE):
                         # Even though this is a 2-cell, it is the end of a
                         # chain.  Put links at the start of the chain.
                         puzzle.cond_set_link(row, col - dc, '|')
@@ -244,34 +306,39 @@ def cellfunc_handle_links_threes(puzzle, row, col):
     coming into one corner of the cell.
     '''
 
-    cellval = puzzle.get_board(row, col)
-    if cellval != '3':
+    board = puzzle.board
+    width = puzzle.board_width
+    i = row * width + col
+
+    if board[i] != THREE_CODE:
         return
 
-    num_links = puzzle.count_adjacent_links(row, col)
+    num_links = puzzle.cell_links[puzzle.cell_index(row, col)]
     if num_links >= 2:
         return
 
     for dr in [-1, 1]:
         for dc in [-1, 1]:
-            dot_row = row + dr
-            dot_col = col + dc
+            # The board index of the corner-dot, and the offsets to the
+            # edges either side of it.
+            dot_i = i + dr * width + dc
+            dr_i = dr * width
 
             # If the 3-cell has a pair of 'x' values outside one corner-dot
             # then there must be two links going into that dot.
-            if puzzle.get_board(dot_row + dr, dot_col) == 'x' and \
-               puzzle.get_board(dot_row, dot_col + dc) == 'x' and \
-               puzzle.get_board(dot_row - dr, dot_col) != 'x' and \
-               puzzle.get_board(dot_row, dot_col - dc) != 'x':
+            if board[dot_i + dr_i] == X_CODE and \
+               board[dot_i + dc] == X_CODE and \
+               board[dot_i - dr_i] != X_CODE and \
+               board[dot_i - dc] != X_CODE:
                 puzzle.cond_set_link(row, col + dc, '|')
                 puzzle.cond_set_link(row + dr, col, '-')
 
             # If the 3-cell has one link coming into one corner-dot then
             # there must be two links going through the opposite corner-dot.
-            if (puzzle.get_board(dot_row + dr, dot_col) in ['-', '|'] or \
-                puzzle.get_board(dot_row, dot_col + dc) in ['-', '|']) and \
-                puzzle.get_board(row - dr, col) != 'x' and \
-                puzzle.get_board(row, col - dc) != 'x':
+            if (board[dot_i + dr_i] in LINK_CODES or \
+                board[dot_i + dc] in LINK_CODES) and \
+                board[i - dr_i] != X_CODE and \
+                board[i - dc] != X_CODE:
 
                 puzzle.cond_set_link(row - dr, col, '-')
                 puzzle.cond_set_link(row, col - dc, '|')
@@ -286,28 +353,26 @@ def dotfunc_avoid_multiple_loops(puzzle, row, col):
     # If there is only one path, we don't mind closing it.  (Not quite right;
     # the path also needs to pass by all cells with values in them, but this
     # is good enough.)
-    if len(puzzle.path_dots) == 1:
+    if puzzle.num_paths == 1:
         return
 
     next_row = row + 2
     next_col = col + 2
 
-    dot1 = (row, col)
-    if dot1 not in puzzle.dot_paths:
+    dot = puzzle.dot_index(row, col)
+    path1 = puzzle.find_path(dot)
+    if path1 < 0:
         # If this dot isn't in a path, just skip it.
         return
 
+    # The dot below is one row of dots further on, and the dot to the right
+    # is the next dot number.
     if next_row < puzzle.board_height:
-        dot2 = (next_row, col)
-        if dot2 in puzzle.dot_paths and \
-           puzzle.dot_paths[dot1] == puzzle.dot_paths[dot2]:
+        if puzzle.find_path(dot + puzzle.cols + 1) == path1:
             puzzle.cond_set_x(row + 1, col)
 
     if next_col < puzzle.board_width:
-        dot2 = (row, next_col)
-        if dot2 in puzzle.dot_paths and \
-           puzzle.dot_paths[dot1] == puzzle.dot_paths[dot2]:
-
+        if puzzle.find_path(dot + 1) == path1:
             puzzle.cond_set_x(row, col + 1)
 
 
@@ -320,11 +385,19 @@ def cellfunc_handle_closed_corners(puzzle, row, col):
     other similar cases arise in the middle of the puzzle.
     '''
 
-    cellval = puzzle.get_board(row, col)
-    if cellval == ' ':
+    board = puzzle.board
+    width = puzzle.board_width
+    i = row * width + col
+
+    cellval = board[i]
+    if cellval == BLANK_CODE:
         return
 
     for dr in [-1, 1]:
+        # The board offsets of one and two rows in the dr direction.
+        dr_i = dr * width
+        dr2_i = 2 * dr_i
+
         for dc in [-1, 1]:
             # This will be true if we have a wall above or below.
             # The value of dr will specify which direction it is.
@@ -338,28 +411,713 @@ def cellfunc_handle_closed_corners(puzzle, row, col):
 
             #if v_wall and h_wall:
 
-            corner = puzzle.get_board(row + 2 * dr, col + dc) == 'x' and \
-                     puzzle.get_board(row + dr, col + 2 * dc) == 'x'
+            corner = board[i + dr2_i + dc] == X_CODE and \
+                     board[i + dr_i + 2 * dc] == X_CODE
 
             if corner:
-                if cellval == '1':
+                if cellval == ONE_CODE:
                     puzzle.cond_set_x(row + dr, col)
                     puzzle.cond_set_x(row, col + dc)
 
-                elif cellval == '2' and \
-                     puzzle.get_board(row + 2 * dr, col - dc) == 'x' and \
-                     puzzle.get_board(row - dr, col + 2 * dc) == 'x':
+                elif cellval == TWO_CODE and \
+                     board[i + dr2_i - dc] == X_CODE and \
+                     board[i - dr_i + 2 * dc] == X_CODE:
 
                     # We can only apply this rule if it's a "hard corner".
                     puzzle.cond_set_link(row + dr, col - 2 * dc, '-')
                     puzzle.cond_set_link(row - 2 * dr, col + dc, '|')
 
-                elif cellval == '3':
+                elif cellval == THREE_CODE:
                     puzzle.cond_set_link(row + dr, col, '-')
                     puzzle.cond_set_link(row, col + dc, '|')
 
 
+# The deductions for each pattern of color classes that the coloring rules
+# have seen, keyed by (kind, pattern) (see color_deductions()).
+COLOR_PATTERNS = {}
+
+# The pairs of cells that the coloring rules look at which have an edge
+# between them, mapped to the position of that edge in the cell_edges or
+# dot_edges of the cell or dot (up, left, right, down).
+CELL_COLOR_EDGES = {(0, 1): 0, (0, 2): 1, (0, 3): 2, (0, 4): 3}
+DOT_COLOR_EDGES = {(0, 1): 0, (0, 3): 1, (1, 2): 2, (2, 3): 3}
+
+
+def color_deductions(kind, pattern):
+    '''
+    Works out what follows from the inside/outside coloring around a
+    numbered cell or a dot.  The loop divides the cells into those inside
+    it and those outside, and an edge is a link exactly when the cells on
+    either side of it have different colors (see Puzzle.join_colors()).
+
+    The pattern has an entry 2 * class + parity for each cell that the
+    rule looks at, where cells with the same class number are known to
+    have the same color if their parities are equal, and different colors
+    otherwise.  Class 0 is the outside.  For a numbered cell (kind is its
+    code), the cells are the cell itself and then its neighbors above, to
+    the left, to the right and below, and the number says how many of the
+    neighbors differ from it.  For a dot (kind is DOT_CODE), the cells are
+    the four around it, going around from the top left, and either zero or
+    two neighboring pairs of them may differ.
+
+    Every way of coloring the classes is tried, and the result lists the
+    relations that are the same in all those that fit, as tuples (i, j,
+    different, edge).  For a pair of cells, i and j are the cells, and
+    edge is the position of the edge between them (see CELL_COLOR_EDGES),
+    or -1 if they aren't next to each other; pairs in the same class are
+    only listed if there is an edge between them.  For a
+    cell that must be inside (different is True) or outside, j and edge
+    are -1.  The result is None if nothing fits.  Patterns repeat all over
+    the board, so the results are cached.
+    '''
+    key = (kind, pattern)
+    result = COLOR_PATTERNS.get(key, False)
+    if result is not False:
+        return result
+
+    if kind == DOT_CODE:
+        edges = DOT_COLOR_EDGES
+    else:
+        edges = CELL_COLOR_EDGES
+
+    classes = [code >> 1 for code in pattern]
+    fits = []
+    for colors in range(0, 1 << (max(classes) + 1), 2):
+        cells = [(code ^ (colors >> (code >> 1))) & 1 for code in pattern]
+        if kind == DOT_CODE:
+            changes = sum(cells[k] != cells[k - 1] for k in range(4))
+            if changes in (0, 2):
+                fits.append(cells)
+        elif sum(cells[k] != cells[0] for k in range(1, 5)) == \
+                kind - ZERO_CODE:
+            fits.append(cells)
+
+    if len(fits) == 0:
+        result = None
+    else:
+        result = []
+        for i in range(len(pattern)):
+            if classes[i] != 0 and \
+               all(cells[i] == fits[0][i] for cells in fits):
+                result.append((i, -1, bool(fits[0][i]), -1))
+
+            for j in range(i + 1, len(pattern)):
+                # Cells in the same class are already related, unless
+                # there is an edge between them to set.
+                edge = edges.get((i, j), -1)
+                if classes[i] == classes[j] and edge < 0:
+                    continue
+
+                different = fits[0][i] != fits[0][j]
+                if all((cells[i] != cells[j]) == different for cells in fits):
+                    result.append((i, j, different, edge))
+
+    COLOR_PATTERNS[key] = result
+    return result
+
+
+def apply_color_deductions(puzzle, kind, colors, edges):
+    '''
+    Looks up the color classes of the cells in colors (color grid indices,
+    see Puzzle.find_color()), and applies the deductions that
+    color_deductions() makes from them.  edges holds the board indices of
+    the edges of the cell or dot, in the order up, left, right, down; when
+    two cells next to each other must be the same or different, the edge
+    between them is set, which joins their classes too.
+    '''
+    # This is find_color() for each cell, written out since it is called
+    # so often.
+    parent = puzzle.color_parent
+    parities = puzzle.color_parity
+    root = 0
+    while parent[root] != root:
+        root = parent[root]
+
+    roots = [root]
+    pattern = []
+    for cc in colors:
+        parity = 0
+        while parent[cc] != cc:
+            parity ^= parities[cc]
+            cc = parent[cc]
+        if cc not in roots:
+            roots.append(cc)
+        pattern.append(2 * roots.index(cc) + parity)
+
+    result = color_deductions(kind, tuple(pattern))
+    if result is None:
+        raise MoveError("No coloring fits around %s" % str(colors))
+
+    for (i, j, different, edge) in result:
+        if edge >= 0:
+            (r, c) = divmod(edges[edge], puzzle.board_width)
+            if not different:
+                puzzle.cond_set_x(r, c)
+            elif r % 2 == 1:
+                puzzle.cond_set_link(r, c, '-')
+            else:
+                puzzle.cond_set_link(r, c, '|')
+        elif j < 0:
+            puzzle.join_colors(colors[i], 0, different)
+        else:
+            puzzle.join_colors(colors[i], colors[j], different)
+
+
+def cellfunc_color_clue(puzzle, row, col):
+    '''
+    Applies the inside/outside coloring to a numbered cell:  the number
+    says how many of its four neighbors are on the other side of the loop
+    from it.  E.g. if two neighbors of a 3 are known to be the same color,
+    they must both differ from the 3, and if two neighbors of a 2 are
+    known to differ, so must the other two.
+    '''
+    cellval = puzzle.board[row * puzzle.board_width + col]
+    if cellval == BLANK_CODE:
+        return
+
+    cell = puzzle.cell_index(row, col)
+    if puzzle.cell_links[cell] + puzzle.cell_xes[cell] == 4:
+        return
+
+    tables = puzzle.tables
+    apply_color_deductions(puzzle, cellval,
+                           tables.cell_colors[5 * cell:5 * cell + 5],
+                           tables.cell_edges[4 * cell:4 * cell + 4])
+
+
+def dotfunc_color_dot(puzzle, row, col):
+    '''
+    Applies the inside/outside coloring to a dot, which has zero or two
+    links, so either zero or two neighboring pairs of the four cells
+    around it can differ.  E.g. if two diagonally opposite cells are known
+    to differ, the loop must pass through the dot.
+    '''
+    dot = puzzle.dot_index(row, col)
+    if puzzle.dot_links[dot] + puzzle.dot_xes[dot] == 4:
+        return
+
+    tables = puzzle.tables
+    apply_color_deductions(puzzle, DOT_CODE,
+                           tables.dot_colors[4 * dot:4 * dot + 4],
+                           tables.dot_edges[4 * dot:4 * dot + 4])
+
+
+# These are the rules applied to each cell and dot in the worklist mode of
+# iter_solve(), in the same order that the full-board sweep applies them.
+CELL_RULES = [
+    cellfunc_handle_closed_corners,
+    cellfunc_fill_in_xes,
+    cellfunc_fill_in_links,
+    cellfunc_handle_adjacent_threes,
+    cellfunc_handle_links_threes,
+    cellfunc_handle_diagonal_ones,
+    cellfunc_color_clue,
+]
+
+DOT_RULES = [
+    dotfunc_fill_in_xes_links,
+    dotfunc_avoid_multiple_loops,
+    dotfunc_color_dot,
+]
+
+# When the vectorized rules are in use, the worklist only applies the rules
+# that apply_vectorized_rules() doesn't cover.
+SCALAR_CELL_RULES = [rule for rule in CELL_RULES
+                     if rule not in [cellfunc_fill_in_xes,
+                                     cellfunc_fill_in_links]]
+
+SCALAR_DOT_RULES = [rule for rule in DOT_RULES
+                    if rule is not dotfunc_fill_in_xes_links]
+
+# The cell rules that can set any edges for a cell with each clue.  Every
+# cell rule starts from the cell's number, so a blank cell has none, and
+# e.g. only a 1 has diagonal 1s to look for.  The x-es around a 0 already
+# give its neighbors its color, so the coloring has nothing to add there.
+CLUE_RULES = {
+    BLANK_CODE: [],
+    ZERO_CODE: [cellfunc_fill_in_xes],
+    ONE_CODE: [cellfunc_handle_closed_corners, cellfunc_fill_in_xes,
+               cellfunc_fill_in_links, cellfunc_handle_diagonal_ones,
+               cellfunc_color_clue],
+    TWO_CODE: [cellfunc_handle_closed_corners, cellfunc_fill_in_xes,
+               cellfunc_fill_in_links, cellfunc_color_clue],
+    THREE_CODE: [cellfunc_handle_closed_corners, cellfunc_fill_in_xes,
+                 cellfunc_fill_in_links, cellfunc_handle_adjacent_threes,
+                 cellfunc_handle_links_threes, cellfunc_color_clue],
+}
+
+# The RuleScheduler times the rules on one in this many runs of the
+# worklist, and updates the schedule after each such run.
+SAMPLE_INTERVAL = 8
+
+# A rule whose yield is less than this fraction of the best rule's yield
+# is backed off by the RuleScheduler.
+BACKOFF_YIELD = 0.1
+
+
+class RuleScheduler:
+    '''
+    Decides which rules the worklist applies to each position, and in what
+    order, from how well the rules have been doing.  A cell only gets the
+    rules that can do something with its clue (see CLUE_RULES).
+
+    On one in SAMPLE_INTERVAL runs of the worklist, every rule applied is
+    timed, and the scheduler adds up the edges that each rule set and the
+    time it took.  After such a run, the rules are put in order of their
+    yield, the edges set per second, so that the cheap rules that find the
+    most go first, and the totals are halved so that recent work counts
+    the most.  The other runs aren't timed, so they cost no more than
+    applying the rules in a fixed order.
+
+    A rule whose yield falls below BACKOFF_YIELD times the best yield is
+    backed off:  when a position that it applies to comes off the
+    worklist, the position is put on a list of deferred positions, and the
+    backed-off rules are only applied to those positions once the worklist
+    is empty.  A position that changes many times before then is only
+    looked at once by them.  If a backed-off rule starts finding edges
+    again, its yield goes back up and it is brought back.  The worklist
+    isn't finished until the deferred positions have been seen to as well,
+    so every rule has still been applied to every position since it last
+    changed, and the rules reach the same fixed point in any order.
+    '''
+
+    def __init__(self, cell_rules, dot_rules, board_size):
+        self.cell_rules = cell_rules
+        self.dot_rules = dot_rules
+        self.rules = cell_rules + dot_rules
+
+        self.edges = dict.fromkeys(self.rules, 0.0)
+        self.seconds = dict.fromkeys(self.rules, 0.0)
+        self.runs = 0
+
+        # The deferred positions, and a flag for each board position that
+        # says whether it is deferred.
+        self.deferred = []
+        self.deferred_flags = bytearray(board_size)
+
+        self.update()
+
+    def start_run(self):
+        '''
+        Counts a run of the worklist, and returns True if the rules should
+        be timed on this run.
+        '''
+        self.runs += 1
+        return self.runs % SAMPLE_INTERVAL == 0
+
+    def update(self):
+        '''
+        Orders the rules by their yield, and works out which of them to back
+        off.  A rule that hasn't been timed yet comes first, and is never
+        backed off.  This must only be called when there are no deferred
+        positions, since they were deferred for the old rules.
+        '''
+        yields = {}
+        for rule in self.rules:
+            if self.seconds[rule] > 0:
+                yields[rule] = self.edges[rule] / self.seconds[rule]
+            else:
+                yields[rule] = float('inf')
+
+            self.edges[rule] /= 2
+            self.seconds[rule] /= 2
+
+        timed = [y for y in yields.values() if y != float('inf')]
+        if len(timed) > 0:
+            threshold = BACKOFF_YIELD * max(timed)
+        else:
+            threshold = 0
+
+        ordered = sorted(self.rules, key=lambda rule: -yields[rule])
+        backed_off = set(rule for rule in ordered if yields[rule] < threshold)
+
+        self.clue_rules = {}
+        self.clue_deferred = {}
+        for (code, rules) in CLUE_RULES.items():
+            rules = [rule for rule in ordered
+                     if rule in rules and rule in self.cell_rules]
+            self.clue_rules[code] = [rule for rule in rules
+                                     if rule not in backed_off]
+            self.clue_deferred[code] = [rule for rule in rules
+                                        if rule in backed_off]
+
+        rules = [rule for rule in ordered if rule in self.dot_rules]
+        self.dot_active = [rule for rule in rules if rule not in backed_off]
+        self.dot_deferred = [rule for rule in rules if rule in backed_off]
+
+    def sample(self, p, rules, r, c):
+        '''
+        Applies the rules to the position at (r, c), timing each of them.
+        '''
+        for rule in rules:
+            edges = p.change_count
+            start = time.perf_counter()
+            try:
+                rule(p, r, c)
+            finally:
+                self.seconds[rule] += time.perf_counter() - start
+                self.edges[rule] += p.change_count - edges
+
+    def take_deferred(self, width):
+        '''
+        Empties the list of deferred positions, and returns the positions
+        that were on it.
+        '''
+        positions = self.deferred
+        self.deferred = []
+        for (r, c) in positions:
+            self.deferred_flags[r * width + c] = 0
+        return positions
+
+    def run_deferred(self, p, sampling):
+        '''
+        Applies the backed-off rules to the deferred positions, timing them
+        if sampling is True.  Returns True if there were any deferred
+        positions, in which case the rules may have put positions back on
+        the worklist.
+        '''
+        positions = self.take_deferred(p.board_width)
+        if len(positions) == 0:
+            return False
+
+        timing = p.rule_stats is not None
+        board = p.board
+        for (r, c) in positions:
+            if r % 2 == 0:
+                rules = self.clue_deferred[board[r * p.board_width + c]]
+            else:
+                rules = self.dot_deferred
+
+            if timing:
+                for rule in rules:
+                    p.apply_rule(rule.__name__, 1, rule, p, r, c)
+            elif sampling:
+                self.sample(p, rules, r, c)
+            else:
+                for rule in rules:
+                    rule(p, r, c)
+
+        return True
+
+
+def count_edges(board, rows, cols, link_codes, x_code):
+    '''
+    Counts the links and x-es on the four edges around each of the
+    positions in the (rows, cols) slices of the 2-D board array.  Returns
+    the (up, down, left, right) edge arrays, and the link and x counts.
+    '''
+    edges = (board[rows.start - 1:rows.stop - 1:2, cols],
+             board[rows.start + 1:rows.stop + 1:2, cols],
+             board[rows, cols.start - 1:cols.stop - 1:2],
+             board[rows, cols.start + 1:cols.stop + 1:2])
+
+    links = sum(numpy.isin(e, link_codes).astype(numpy.int8) for e in edges)
+    xes = sum((e == x_code).astype(numpy.int8) for e in edges)
+    return (edges, links, xes)
+
+
+def apply_vectorized_rules(puzzle):
+    '''
+    Applies the rules in cellfunc_fill_in_xes(), cellfunc_fill_in_links()
+    and dotfunc_fill_in_xes_links() to the whole board at once, using NumPy
+    to count the links and x-es around every cell and dot.  The edges are
+    still set through cond_set_x() and cond_set_link(), so the path
+    information, hash, undo trail and worklist are kept up to date.
+    Returns True if any edges were set, or raises MoveError if the rules
+    contradict each other.
+
+    All of the rules look at the board as it was before any of them made
+    changes, so the caller should keep applying them until they stop
+    making changes.
+    '''
+    board = numpy.frombuffer(puzzle.board, dtype=numpy.uint8).reshape(
+        puzzle.board_height, puzzle.board_width)
+
+    cell_rows = slice(2, 2 * puzzle.rows + 1, 2)
+    cell_cols = slice(2, 2 * puzzle.cols + 1, 2)
+    (cell_edges, links, xes) = count_edges(board, cell_rows, cell_cols,
+                                           LINK_CODES, X_CODE)
+
+    cells = board[cell_rows, cell_cols]
+    numbered = (cells >= ZERO_CODE) & (cells <= THREE_CODE)
+    required = cells.astype(numpy.int8) - ZERO_CODE
+
+    cell_xes = numbered & (links == required) & (links + xes != 4)
+    cell_links = numbered & (links < required) & (4 - xes == required)
+
+    dot_rows = slice(1, 2 * puzzle.rows + 2, 2)
+    dot_cols = slice(1, 2 * puzzle.cols + 2, 2)
+    (dot_edges, links, xes) = count_edges(board, dot_rows, dot_cols,
+                                          LINK_CODES, X_CODE)
+
+    dot_xes = ((links == 2) & (xes < 2)) | (xes == 3)
+    dot_links = (xes == 2) & (links == 1)
+
+    # A path that runs into a dot with no other way out can't be part of
+    # the loop.  The one-position-at-a-time rules usually run into this
+    # as a third link somewhere, but the order that the rules are applied
+    # in here can let it through, so it is checked for directly.
+    dead_ends = (links == 1) & (xes == 3)
+    if dead_ends.any():
+        (i, j) = [int(v[0]) for v in numpy.nonzero(dead_ends)]
+        raise MoveError("Dot %s is a dead end" % str((1 + 2 * i, 1 + 2 * j)))
+
+    # Work out every edge to set before setting any, since setting edges
+    # changes the board array.  Each entry is (mask, edge arrays, first
+    # row, first column, value), and the edges are up, down, left, right.
+    x_edges = []
+    link_edges = []
+    for (mask, edges, row0, col0, targets, vertical) in [
+            (cell_xes, cell_edges, 2, 2, x_edges, '-'),
+            (cell_links, cell_edges, 2, 2, link_edges, '-'),
+            (dot_xes, dot_edges, 1, 1, x_edges, '|'),
+            (dot_links, dot_edges, 1, 1, link_edges, '|')]:
+        if not mask.any():
+            continue
+
+        # The up and down edges of a cell are '-', and of a dot are '|'.
+        if vertical == '-':
+            across = '|'
+        else:
+            across = '-'
+
+        for (edge, dr, dc, value) in [(edges[0], -1, 0, vertical),
+                                      (edges[1], 1, 0, vertical),
+                                      (edges[2], 0, -1, across),
+                                      (edges[3], 0, 1, across)]:
+            (i_rows, i_cols) = numpy.nonzero(mask & (edge == BLANK_CODE))
+            for (i, j) in zip(i_rows.tolist(), i_cols.tolist()):
+                targets.append((row0 + 2 * i + dr, col0 + 2 * j + dc, value))
+
+    del board
+
+    # An edge that one rule needs to be an 'x' and another needs to be a
+    # link means that the board can't be solved.
+    conflicts = set((r, c) for (r, c, value) in x_edges) & \
+                set((r, c) for (r, c, value) in link_edges)
+    if len(conflicts) > 0:
+        raise MoveError("Edge %s must be both an 'x' and a link" %
+                        str(min(conflicts)))
+
+    start_count = puzzle.change_count
+    for (r, c, value) in x_edges:
+        puzzle.cond_set_x(r, c)
+    for (r, c, value) in link_edges:
+        puzzle.cond_set_link(r, c, value)
+
+    return puzzle.change_count != start_count
+
+
+# The labels that get_board_color() gives the cells.
 OUTSIDE_COLOR = 'o'
+INSIDE_COLOR = 'i'
+UNKNOWN_COLOR = '?'
+
+# Maps board bytes to the 2-bit edge states kept in packed board states
+# (see Puzzle.get_state()):  0 for an unknown edge, 1 for an 'x' and 2 for
+# a link.
+EDGE_STATES = bytes.maketrans(b' x-|', b'\x00\x01\x02\x02')
+
+# The seed used to generate the Zobrist keys for hashing boards.  It is
+# fixed so that a board always gets the same hash value.
+ZOBRIST_SEED = 0x51174e4
+
+
+class BoardTables:
+    '''
+    Lookup tables that depend only on the size of the board.  These are
+    built once for each board size, and shared by every puzzle of that
+    size, including copies made with copy.deepcopy().
+    '''
+
+    cache = {}
+
+    @classmethod
+    def for_size(cls, rows, cols):
+        tables = cls.cache.get((rows, cols))
+        if tables is None:
+            tables = BoardTables(rows, cols)
+            cls.cache[(rows, cols)] = tables
+
+        return tables
+
+    def __init__(self, rows, cols):
+        board_size = (2 * (rows + 1) + 1) * (2 * (cols + 1) + 1)
+
+        # The Zobrist keys:  a random 64-bit value for each board position
+        # holding an 'x' or a link.  The hash of a board is the XOR of the
+        # keys of every edge that has been set, so it can be updated with
+        # one XOR whenever an edge changes.  Blank edges contribute 0.
+        rng = random.Random(ZOBRIST_SEED)
+        x_keys = [rng.getrandbits(64) for i in range(board_size)]
+        link_keys = [rng.getrandbits(64) for i in range(board_size)]
+
+        self.zobrist = {X_CODE: x_keys, H_LINK_CODE: link_keys,
+                        V_LINK_CODE: link_keys}
+
+        # The adjacency tables.  Every edge on the board has an edge ID,
+        # numbered row by row:  edge_positions maps each edge ID to its
+        # board index, and edge_ids maps each board index to its edge ID,
+        # or -1 if it isn't an edge.  Cells are numbered row by row (see
+        # Puzzle.cell_index()) and so are dots (see Puzzle.dot_index()).
+        # cell_edges and dot_edges hold the board indices of the four
+        # positions around each cell and dot, in the order up, left,
+        # right, down; for a dot on the border, some of these are the 'x'
+        # positions of the frame rather than edges.  edge_dots and
+        # edge_cells hold the two dots and the two cells on either side
+        # of each edge ID, with -1 for a cell outside the board.
+        width = 2 * (cols + 1) + 1
+        self.edge_ids = array('i', [-1]) * board_size
+        self.edge_positions = array('i')
+        self.edge_dots = array('i')
+        self.edge_cells = array('i')
+
+        for r in range(1, 2 * rows + 2):
+            for c in range(1 + r % 2, 2 * cols + 2, 2):
+                self.edge_ids[r * width + c] = len(self.edge_positions)
+                self.edge_positions.append(r * width + c)
+
+                if r % 2 == 1:
+                    ends = [(r, c - 1), (r, c + 1)]
+                    sides = [(r - 1, c), (r + 1, c)]
+                else:
+                    ends = [(r - 1, c), (r + 1, c)]
+                    sides = [(r, c - 1), (r, c + 1)]
+
+                for (dr, dc) in ends:
+                    self.edge_dots.append((dr // 2) * (cols + 1) + dc // 2)
+
+                for (cr, cc) in sides:
+                    if 2 <= cr <= 2 * rows and 2 <= cc <= 2 * cols:
+                        self.edge_cells.append((cr // 2 - 1) * cols +
+                                               cc // 2 - 1)
+                    else:
+                        self.edge_cells.append(-1)
+
+        self.cell_edges = array('i')
+        for r in range(2, 2 * rows + 1, 2):
+            for c in range(2, 2 * cols + 1, 2):
+                i = r * width + c
+                self.cell_edges.extend([i - width, i - 1, i + 1, i + width])
+
+        self.dot_edges = array('i')
+        for r in range(1, 2 * rows + 2, 2):
+            for c in range(1, 2 * cols + 2, 2):
+                i = r * width + c
+                self.dot_edges.extend([i - width, i - 1, i + 1, i + width])
+
+        # The tables for the inside/outside coloring (see
+        # Puzzle.find_color()).  The color grid has a cell for every cell
+        # of the board, plus a ring of cells around it that stand for the
+        # outside, so the cell at board position (r, c) is color cell
+        # (r // 2, c // 2).  edge_colors holds the two color cells on either
+        # side of each edge ID.  cell_colors holds the color cells of each
+        # cell and its neighbors, in the order the coloring rule uses:  the
+        # cell, then up, left, right, down.  dot_colors holds the four
+        # color cells around each dot, going around from the top left.
+        # color_watchers lists the board positions of the cells and dots
+        # whose coloring rules look at each color cell.
+        color_width = cols + 2
+        self.edge_colors = array('i')
+        for i in self.edge_positions:
+            (r, c) = divmod(i, width)
+            if r % 2 == 1:
+                sides = [(r - 1, c), (r + 1, c)]
+            else:
+                sides = [(r, c - 1), (r, c + 1)]
+            for (cr, cc) in sides:
+                self.edge_colors.append((cr // 2) * color_width + cc // 2)
+
+        self.cell_colors = array('i')
+        for i in range(1, rows + 1):
+            for j in range(1, cols + 1):
+                cc = i * color_width + j
+                self.cell_colors.extend([cc, cc - color_width, cc - 1,
+                                         cc + 1, cc + color_width])
+
+        self.dot_colors = array('i')
+        for i in range(rows + 1):
+            for j in range(cols + 1):
+                cc = i * color_width + j
+                self.dot_colors.extend([cc, cc + 1, cc + color_width + 1,
+                                        cc + color_width])
+
+        self.color_watchers = [[] for cc in range((rows + 2) * color_width)]
+        for i in range(1, rows + 1):
+            for j in range(1, cols + 1):
+                for (ci, cj) in [(i, j), (i - 1, j), (i, j - 1), (i, j + 1),
+                                 (i + 1, j)]:
+                    self.color_watchers[ci * color_width + cj].append(
+                        (2 * i, 2 * j))
+        for i in range(rows + 1):
+            for j in range(cols + 1):
+                for (ci, cj) in [(i, j), (i, j + 1), (i + 1, j),
+                                 (i + 1, j + 1)]:
+                    self.color_watchers[ci * color_width + cj].append(
+                        (2 * i + 1, 2 * j + 1))
+
+        # A packed board state holds 2 bits for each edge, four edges to a
+        # byte.  state_mask has the low 2 bits of every byte set, to pick
+        # out one edge from each byte.
+        self.state_size = (len(self.edge_positions) + 3) // 4
+        self.state_mask = int.from_bytes(b'\x03' * self.state_size, 'little')
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def hash_key(self, value, index):
+        '''
+        Returns the Zobrist key for the board byte value at the specified
+        board index.
+        '''
+        keys = self.zobrist.get(value)
+        if keys is None:
+            return 0
+        return keys[index]
+
+
+class TranspositionTable:
+    '''
+    Records the hashes of boards that the search has already seen, so that
+    it can skip boards it reaches again by a different order of moves.  The
+    table holds at most max_size hashes; once it is full, the least
+    recently used hash is evicted to make room.  The hits and misses
+    counters record how lookups went.
+    '''
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, board_hash):
+        '''
+        Reports whether the specified board hash is in the table.
+        '''
+        if board_hash in self.entries:
+            self.entries.move_to_end(board_hash)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def add(self, board_hash):
+        '''
+        Adds the specified board hash to the table, evicting the least
+        recently used hash if the table is full.
+        '''
+        self.entries[board_hash] = True
+        self.entries.move_to_end(board_hash)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
 
 class Puzzle:
     def __init__(self, rows, cols, cell_values):
@@ -419,11 +1177,36 @@ class Puzzle:
             'board-height %d doesn\'t match length of board %d' % \
             (len(self.board), self.board_height)
 
+        # The clues never change, so they are kept apart from the board
+        # as well, one byte per cell numbered as in cell_index().  The
+        # bytes object is immutable, so copies of the puzzle share it.
+        self.clues = bytes(self.board[r * self.board_width + c]
+                           for r in range(2, 2 * rows + 1, 2)
+                           for c in range(2, 2 * cols + 1, 2))
+
+        # The answers of is_lone_loop(), which only depend on the clues.
+        self.lone_loops = {}
+
         # These fields are used to keep track of the different paths
-        # in the solution.
-        self.next_path_id = 1
-        self.dot_paths = {}
-        self.path_dots = {}
+        # in the solution.  The dots are numbered row by row (see
+        # dot_index()), and the paths are kept in a disjoint-set forest
+        # over the dot numbers:  dot_parent is -1 for a dot that isn't on
+        # any path, and dot_size holds the number of dots in each path,
+        # stored at the path's root.  Since every path is a simple chain,
+        # path_end records the other end of the path for each dot at the
+        # end of a path, and -1 for every other dot.
+        num_dots = (rows + 1) * (cols + 1)
+        self.dot_parent = array('i', [-1]) * num_dots
+        self.dot_size = array('i', [0]) * num_dots
+        self.path_end = array('i', [-1]) * num_dots
+        self.num_paths = 0
+        self.loop_closed = False
+
+        # When the undo trail is enabled (see start_trail()), every change
+        # to the board and the path information is recorded on it as a
+        # (container, key, old value) tuple, so that the search can back
+        # out of a move instead of copying the puzzle for every move.
+        self.trail = None
 
         # This value is used to keep track if the puzzle state has
         # been changed.  If we attempt to apply solution rules and
@@ -431,51 +1214,310 @@ class Puzzle:
         self.changed = False
         self.change_count = 0
 
-        self.board_colors = bytearray((self.rows + 2) * (self.cols + 2))
-
-        for r in range(1, self.rows + 2):
-            for c in range(1, self.cols + 2):
-                self.set_board_color(r, c, 'i');
-
-        for r in range(self.rows + 2):
-            self.set_board_color(r, 0, OUTSIDE_COLOR)
-            self.set_board_color(r, self.cols + 1, OUTSIDE_COLOR)
+        # If this is True, and NumPy is installed, the worklist mode of
+        # iter_solve() applies some of the rules to the whole board at once
+        # with apply_vectorized_rules().
+        self.vectorized = False
+
+        # The number of edge values that probe_edges() may try each time
+        # the search calls it, which is 0 to leave it out, and the number
+        # it has tried in all.
+        self.probe_limit = 0
+        self.probes = 0
+
+        # The RuleScheduler that picks the rules the worklist applies, which
+        # run_worklist() sets up.
+        self.scheduler = None
+
+        # The number of passes that iter_solve() has made over the rules.
+        self.passes = 0
+
+        # If this is a RuleStats object, iter_solve() counts and times the
+        # work done by each rule in it.  num_positions is the number of
+        # cells and dots, which the checks of the whole board look at.
+        self.rule_stats = None
+        self.num_positions = rows * cols + num_dots
+
+        # The tables shared by all boards of this size, and the Zobrist
+        # hash of the current board (see BoardTables), which set_board()
+        # keeps up to date.
+        self.tables = BoardTables.for_size(rows, cols)
+        self.board_hash = 0
+
+        # The number of links and x-es around each cell and dot, numbered
+        # as in cell_index() and dot_index().  set_board() and undo() keep
+        # these up to date, so that the rules can look the counts up
+        # instead of scanning the board around each position.
+        self.cell_links = bytearray(rows * cols)
+        self.cell_xes = bytearray(rows * cols)
+        self.dot_links = bytearray(num_dots)
+        self.dot_xes = bytearray(num_dots)
+
+        # The only edges set on a new board are the x-es of the frame
+        # around the outside dots.
+        for dot in range(num_dots):
+            for i in self.tables.dot_edges[4 * dot:4 * dot + 4]:
+                if self.board[i] == X_CODE:
+                    self.dot_xes[dot] += 1
+
+        # This is the worklist used by the event-driven propagation mode of
+        # iter_solve().  Whenever an edge is set, the cells and dots whose
+        # rules can see that edge are queued up, so that only they need to
+        # be re-checked.  The queued array records which board positions
+        # are already in the worklist.  Every cell and dot starts out queued.
+        self.pending = deque()
+        self.queued = bytearray(len(self.board))
 
-        for c in range(self.cols + 2):
-            self.set_board_color(0, c, OUTSIDE_COLOR)
-            self.set_board_color(self.rows + 1, c, OUTSIDE_COLOR)
+        for r in range(1, 2 * self.rows + 2):
+            for c in range(1, 2 * self.cols + 2):
+                if r % 2 == c % 2:
+                    self.queue_position(r, c)
+
+        # The inside/outside coloring of the cells, on the color grid of
+        # BoardTables, which has a ring of outside cells around the board.
+        # Cells known to have the same or different colors are kept in
+        # classes, in a disjoint-set forest:  color_parent points towards
+        # the root of each cell's class, and color_parity is 1 if the cell
+        # has the other color from its parent.  color_size holds the size
+        # of each class at its root, and color_next links the cells of
+        # each class in a ring, so that they can be found when classes are
+        # joined.  The ring of outside cells starts out as one class,
+        # rooted at color cell 0.
+        num_colors = (self.rows + 2) * (self.cols + 2)
+        self.color_parent = array('i', range(num_colors))
+        self.color_parity = bytearray(num_colors)
+        self.color_size = array('i', [1]) * num_colors
+        self.color_next = array('i', range(num_colors))
+
+        for cc in range(1, num_colors):
+            (i, j) = divmod(cc, self.cols + 2)
+            if i in (0, self.rows + 1) or j in (0, self.cols + 1):
+                self.join_colors(cc, 0, False)
+
+    def check_position(self, r, c):
+        '''
+        Raises an IndexError if the specified position is off the board.
+        This is only called when CHECK_BOUNDS is True.
+        '''
+        if r < 0 or r >= self.board_height:
+            raise IndexError("Invalid row index %d (must be in range "
+                             "[0, %d))" % (r, self.board_height))
+        if c < 0 or c >= self.board_width:
+            raise IndexError("Invalid column index %d (must be in range "
+                             "[0, %d))" % (c, self.board_width))
 
     def get_board(self, r, c):
-        assert r >= 0 and r < self.board_height, \
-            "Invalid row index %d (must be in range [0, %d)" % \
-            (r, self.board_height)
-        assert c >= 0 and c < self.board_width, \
-            "Invalid column index %d (must be in range [0, %d)" % \
-            (c, self.board_width)
+        if CHECK_BOUNDS:
+            self.check_position(r, c)
 
         return chr(self.board[r * self.board_width + c])
 
+    def get_code(self, r, c):
+        '''
+        Returns the byte code at the specified position, e.g. X_CODE,
+        without converting it to a string as get_board() does.
+        '''
+        if CHECK_BOUNDS:
+            self.check_position(r, c)
+
+        return self.board[r * self.board_width + c]
+
     def set_board(self, r, c, val):
-        assert r >= 0 and r < self.board_height, \
-            "Invalid row index %d (must be in range [0, %d)" % \
-            (r, self.board_height)
-        assert c >= 0 and c < self.board_width, \
-            "Invalid column index %d (must be in range [0, %d)" % \
-            (c, self.board_width)
+        if CHECK_BOUNDS:
+            self.check_position(r, c)
+
+        self.set_code(r * self.board_width + c, ord(val))
+
+    def set_code(self, index, value):
+        '''
+        Sets the specified board index to the specified byte code, keeping
+        the undo trail, the board hash and the link and x counts up to
+        date.  set_board() does the same for a (row, col) position and a
+        one-character string.
+        '''
+        old_value = self.board[index]
+        if self.trail is not None:
+            self.trail.append((self.board, index, old_value))
+
+        self.board[index] = value
+        self.board_hash ^= self.tables.hash_key(old_value, index) ^ \
+                           self.tables.hash_key(value, index)
+        self.update_counts(index, old_value, value)
 
-        self.board[r * self.board_width + c] = ord(val)
+    def update_counts(self, index, old_value, value):
+        '''
+        Updates the link and x counts of the cells and dots around the
+        specified board index, when its value changes from old_value to
+        value.  Positions that aren't edges don't affect any counts.
+        '''
+        edge = self.tables.edge_ids[index]
+        if edge < 0:
+            return
+
+        links = (value in LINK_CODES) - (old_value in LINK_CODES)
+        xes = (value == X_CODE) - (old_value == X_CODE)
+
+        for dot in self.tables.edge_dots[2 * edge:2 * edge + 2]:
+            self.dot_links[dot] += links
+            self.dot_xes[dot] += xes
+
+        for cell in self.tables.edge_cells[2 * edge:2 * edge + 2]:
+            if cell >= 0:
+                self.cell_links[cell] += links
+                self.cell_xes[cell] += xes
 
     def set_board_color(self, r, c, val):
+        '''
+        Records that the cell at (r, c) of the color grid, where the board
+        is rows 1 to rows and columns 1 to cols, is inside the loop
+        (INSIDE_COLOR) or outside it (OUTSIDE_COLOR).
+        '''
         assert r >= 0 and r < self.rows + 2
         assert c >= 0 and c < self.cols + 2
+        assert val in (INSIDE_COLOR, OUTSIDE_COLOR)
 
-        self.board_colors[r * (self.cols + 2) + c] = ord(val)
+        self.join_colors(r * (self.cols + 2) + c, 0, val == INSIDE_COLOR)
 
     def get_board_color(self, r, c):
+        '''
+        Returns INSIDE_COLOR or OUTSIDE_COLOR for the cell at (r, c) of the
+        color grid (see set_board_color()), or UNKNOWN_COLOR if it isn't
+        known yet which side of the loop it is on.
+        '''
         assert r >= 0 and r < self.rows + 2
         assert c >= 0 and c < self.cols + 2
 
-        return chr(self.board_colors[r * (self.cols + 2) + c])
+        (root, parity) = self.find_color(r * (self.cols + 2) + c)
+        if root != self.outside_root():
+            return UNKNOWN_COLOR
+        elif parity:
+            return INSIDE_COLOR
+        else:
+            return OUTSIDE_COLOR
+
+    def find_color(self, cc):
+        '''
+        Returns (root, parity) for the cell cc of the color grid, where root
+        is the root of its class, and parity is 1 if the cell has the other
+        color from the root.  The classes are joined by size, so the trees
+        stay shallow, and the paths aren't compressed.
+        '''
+        parent = self.color_parent
+        parity = 0
+        while parent[cc] != cc:
+            parity ^= self.color_parity[cc]
+            cc = parent[cc]
+        return (cc, parity)
+
+    def outside_root(self):
+        '''
+        Returns the root of the class of the cells outside the loop.
+        '''
+        return self.find_color(0)[0]
+
+    def join_colors(self, cc1, cc2, different):
+        '''
+        Records that the color cells cc1 and cc2 have different colors if
+        different is True, and the same color otherwise, joining their
+        classes.  A MoveError is raised if that contradicts what is already
+        known.  The cells and dots whose coloring rules look at the cells
+        of the smaller class are queued up, since those cells are now
+        related to more of the board.
+        '''
+        (root1, parity1) = self.find_color(cc1)
+        (root2, parity2) = self.find_color(cc2)
+        different = int(different)
+
+        if root1 == root2:
+            if parity1 ^ parity2 != different:
+                raise MoveError("Color cells %d and %d can't be both the "
+                                "same and different" % (cc1, cc2))
+            return
+
+        if self.color_size[root1] < self.color_size[root2]:
+            (root1, root2) = (root2, root1)
+
+        # Queue up the rules that look at the smaller class, root2.
+        width = self.board_width
+        queued = self.queued
+        pending = self.pending
+        watchers = self.tables.color_watchers
+        cc = root2
+        while True:
+            for (r, c) in watchers[cc]:
+                i = r * width + c
+                if not queued[i]:
+                    queued[i] = 1
+                    pending.append((r, c))
+            cc = self.color_next[cc]
+            if cc == root2:
+                break
+
+        self.set_changed()
+        self.store(self.color_parent, root2, root1)
+        self.store(self.color_parity, root2, parity1 ^ parity2 ^ different)
+        self.store(self.color_size, root1,
+                   self.color_size[root1] + self.color_size[root2])
+
+        # Splice the two rings of cells together.
+        next1 = self.color_next[root1]
+        self.store(self.color_next, root1, self.color_next[root2])
+        self.store(self.color_next, root2, next1)
+
+
+    def record(self, values, key):
+        '''
+        Saves the current value of values[key] on the undo trail, if the
+        trail is enabled, so that undo() can restore it later.
+        '''
+        if self.trail is not None:
+            self.trail.append((values, key, values[key]))
+
+
+    def store(self, values, key, value):
+        '''
+        Sets values[key] to the specified value, recording the old value
+        on the undo trail first.
+        '''
+        self.record(values, key)
+        values[key] = value
+
+
+    def start_trail(self):
+        '''
+        Enables the undo trail.  From this point on, every change to the
+        puzzle can be backed out with checkpoint() and undo().
+        '''
+        self.trail = []
+
+
+    def checkpoint(self):
+        '''
+        Returns a marker for the current state of the puzzle, which can
+        later be passed to undo() to return to this state.  Checkpoints
+        should only be taken when the worklist is empty, e.g. after
+        iter_solve() has finished.
+        '''
+        return len(self.trail)
+
+
+    def undo(self, mark):
+        '''
+        Backs out every change made since the specified checkpoint.  Any
+        positions left in the worklist refer to the abandoned state, so
+        the worklist is cleared as well.
+        '''
+        trail = self.trail
+        board = self.board
+        while len(trail) > mark:
+            (values, key, value) = trail.pop()
+            if values is board:
+                self.board_hash ^= self.tables.hash_key(board[key], key) ^ \
+                                   self.tables.hash_key(value, key)
+                self.update_counts(key, board[key], value)
+            values[key] = value
+
+        self.clear_worklist()
 
 
     def is_changed(self):
@@ -507,6 +1549,79 @@ class Puzzle:
         return str(self.board)
 
 
+    def get_edge_states(self):
+        '''
+        Returns the state of every edge as a bytes object, one byte per edge
+        in edge ID order (see BoardTables), using the values of
+        EDGE_STATES.
+        '''
+        width = self.board_width
+        stop = 2 * self.cols + 2
+        edges = b''.join(self.board[r * width + 1 + r % 2:r * width + stop:2]
+                         for r in range(1, 2 * self.rows + 2))
+        return edges.translate(EDGE_STATES)
+
+
+    def get_state(self):
+        '''
+        Returns the current state of the edges as a bytes object, packed 2
+        bits to an edge (see EDGE_STATES), four edges to a byte.  The clues
+        and the frame never change, so they are left out, and the state is
+        a fraction of the size of the board.  Two states of the same
+        puzzle are equal exactly when the boards are.  The state can be
+        passed to load_state() or puzzle_from_state() to recreate the
+        board, e.g. in another process.
+        '''
+        edges = self.get_edge_states()
+
+        # Edge i goes in bits 2 * (i % 4) of byte i // 4.  Every edge state
+        # fits in 2 bits, so the four sets of edges can be shifted into
+        # place and combined as whole integers.
+        packed = 0
+        for k in range(4):
+            packed |= int.from_bytes(edges[k::4], 'little') << (2 * k)
+
+        return packed.to_bytes(self.tables.state_size, 'little')
+
+
+    def unpack_state(self, state):
+        '''
+        Returns the edge states in a packed state from get_state(), in the
+        form that get_edge_states() returns them.
+        '''
+        num_edges = len(self.tables.edge_positions)
+        packed = int.from_bytes(state, 'little')
+
+        edges = bytearray(num_edges)
+        for k in range(min(4, num_edges)):
+            lane = (packed >> (2 * k)) & self.tables.state_mask
+            edges[k::4] = lane.to_bytes(self.tables.state_size,
+                                        'little')[:(num_edges - k + 3) // 4]
+
+        return bytes(edges)
+
+
+    def load_state(self, state):
+        '''
+        Sets every edge that is set in the specified packed state (see
+        get_state()) but still unknown on this board.  The state must come
+        from a puzzle with the same clues.  The path information is built
+        up as the links are added.
+        '''
+        positions = self.tables.edge_positions
+        for (edge, value) in enumerate(self.unpack_state(state)):
+            if value == 0:
+                continue
+
+            (r, c) = divmod(positions[edge], self.board_width)
+            if value == 1:
+                self.cond_set_x(r, c)
+            elif r % 2 == 1:
+                self.cond_set_link(r, c, '-')
+            else:
+                self.cond_set_link(r, c, '|')
+
+
     def pretty_print(self, include_xes = True, include_numbers = True):
         '''
         Pretty-prints out the puzzle board.
@@ -533,31 +1648,119 @@ class Puzzle:
 
 
     def is_solved(self):
-        # There must be only one path
-        if len(self.path_dots) > 1:
+        # There must be only one path, and it must be closed.  (Every dot
+        # in a closed path has exactly two links around it.)
+        if self.num_paths != 1 or not self.loop_closed:
             return False
 
         # Each cell with a number in it must have that many links
         # around that cell.
         for r in range(2, 2 * self.rows + 1, 2):
+            row_start = r * self.board_width
             for c in range(2, 2 * self.cols + 1, 2):
-                val = self.get_board(r, c)
-                if val != ' ':
-                    required = int(val)
-                    actual = self.count_adjacent_links(r, c)
+                val = self.board[row_start + c]
+                if val != BLANK_CODE:
+                    required = val - ZERO_CODE
+                    actual = self.cell_links[self.cell_index(r, c)]
                     if required != actual:
                         return False
 
-        # Each dot in the path must have exactly two links
-        # around it.  (This ensures that the path is closed.)
-        path_id = list(self.path_dots.keys())[0]
-        path = self.path_dots[path_id]
-        for dot in path:
-            (r, c) = dot
-            links = self.count_adjacent_links(r, c)
-            assert links <= 2, \
-                "Invalid number of links at (%d,%d):  %d" % (r, c, links)
-            if links != 2:
+        return True
+
+
+    def find_unmet_clue(self):
+        '''
+        Returns the number of the first numbered cell (see cell_index())
+        that doesn't have as many links around it as its number, or -1 if
+        every clue is met.
+        '''
+        cell_links = self.cell_links
+        for (cell, code) in enumerate(self.clues):
+            if code != BLANK_CODE and cell_links[cell] != code - ZERO_CODE:
+                return cell
+
+        return -1
+
+
+    def can_form_loop(self):
+        '''
+        Reports whether the links on the board could still be joined up
+        into a single loop that meets every clue.  Following only the edges
+        that aren't x-es, every link must be able to reach every other
+        link, and every numbered cell that still needs links must be
+        reachable too.  If a link is cut off from the rest, or from a clue
+        that needs it, no choice of the unknown edges can make one loop,
+        even though the rules around each cell and dot are all happy.
+
+        This looks at the whole board, so the search calls it once for
+        each board it reaches, rather than the rules calling it as edges
+        are set.
+        '''
+        if self.loop_closed:
+            # link_dots() already checked that the clues are all met.
+            return True
+
+        board = self.board
+        tables = self.tables
+        dot_edges = tables.dot_edges
+        dot_links = self.dot_links
+        clues = self.clues
+        cell_links = self.cell_links
+
+        cell_edges = tables.cell_edges
+        edge_ids = tables.edge_ids
+        edge_dots = tables.edge_dots
+
+        # Start from a dot with a link on it, or if there are no links yet,
+        # from an unknown edge of the first cell that needs some.
+        start = len(dot_links) - len(dot_links.lstrip(b'\x00'))
+        if start == len(dot_links):
+            for (cell, code) in enumerate(clues):
+                if code != BLANK_CODE and cell_links[cell] < code - ZERO_CODE:
+                    break
+            else:
+                return True
+
+            for i in cell_edges[4 * cell:4 * cell + 4]:
+                if board[i] == BLANK_CODE:
+                    start = edge_dots[2 * edge_ids[i]]
+                    break
+            else:
+                # can_solve() reports a cell with too many x-es.
+                return True
+
+        step = self.cols + 1
+        offsets = (-step, -1, 1, step)
+        reached = bytearray(len(dot_links))
+        reached[start] = 1
+        stack = [start]
+        while stack:
+            dot = stack.pop()
+            i = 4 * dot
+            for k in range(4):
+                if board[dot_edges[i + k]] != X_CODE:
+                    next_dot = dot + offsets[k]
+                    if not reached[next_dot]:
+                        reached[next_dot] = 1
+                        stack.append(next_dot)
+
+        for dot in range(len(dot_links)):
+            if dot_links[dot] and not reached[dot]:
+                log.log(TRACE, "Can't solve:  the link at dot %s is cut off "
+                        "from the others", self.dot_position(dot))
+                return False
+
+        for (cell, code) in enumerate(clues):
+            if code == BLANK_CODE or cell_links[cell] >= code - ZERO_CODE:
+                continue
+
+            for i in cell_edges[4 * cell:4 * cell + 4]:
+                if board[i] == BLANK_CODE and \
+                   reached[edge_dots[2 * edge_ids[i]]]:
+                    break
+            else:
+                log.log(TRACE, "Can't solve:  cell %d can't be reached by "
+                        "the loop", cell)
                 return False
 
         return True
@@ -570,38 +1773,73 @@ class Puzzle:
         specified number of links then report false.
         '''
         for r in range(2, 2 * self.rows + 1, 2):
+            row_start = r * self.board_width
             for c in range(2, 2 * self.cols + 1, 2):
-                val = self.get_board(r, c)
-                if val != ' ':
-                    required = int(val)
-                    actual = self.count_adjacent_links(r, c)
-                    xes = self.count_adjacent_xes(r, c)
+                val = self.board[row_start + c]
+                if val != BLANK_CODE:
+                    required = val - ZERO_CODE
+                    cell = self.cell_index(r, c)
+                    actual = self.cell_links[cell]
+                    xes = self.cell_xes[cell]
 
                     if 4 - xes < required:
-                        print("Can't solve:  too many x-es around the cell")
+                        log.log(TRACE, "Can't solve:  too many x-es around "
+                                "the cell at (%d, %d)", r, c)
                         return False
 
                     if actual + xes == 4 and required != actual:
-                        print("Can't solve:  wrong number of links around cell")
+                        log.log(TRACE, "Can't solve:  wrong number of links "
+                                "around the cell at (%d, %d)", r, c)
                         return False
 
         return True
 
 
     def iter_cells(self, cell_func):
-        for r in range(2, 2 * self.rows + 1, 2):
-            for c in range(2, 2 * self.cols + 1, 2):
-                cell_func(self, r, c)
+        def sweep():
+            for r in range(2, 2 * self.rows + 1, 2):
+                for c in range(2, 2 * self.cols + 1, 2):
+                    cell_func(self, r, c)
+
+        self.apply_rule(cell_func.__name__, self.rows * self.cols, sweep)
 
 
     def iter_dots(self, dot_func):
-        for r in range(1, 2 * self.rows + 2, 2):
-            for c in range(1, 2 * self.cols + 2, 2):
-                #print('(%d, %d)' % (r, c))
-                dot_func(self, r, c)
+        def sweep():
+            for r in range(1, 2 * self.rows + 2, 2):
+                for c in range(1, 2 * self.cols + 2, 2):
+                    #print('(%d, %d)' % (r, c))
+                    dot_func(self, r, c)
+
+        self.apply_rule(dot_func.__name__, (self.rows + 1) * (self.cols + 1),
+                        sweep)
+
+
+    def apply_rule(self, name, positions, func, *args):
+        '''
+        Calls func(*args), which applies the rule called name to the
+        specified number of positions, and returns what it returns.  If
+        rule_stats is set, the call is counted and timed in it.
+        '''
+        stats = self.rule_stats
+        if stats is None:
+            return func(*args)
+
+        edges = self.change_count
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            stats.add(name, 1, time.perf_counter() - start, positions,
+                      self.change_count - edges)
 
 
     def count_adjacent_links(self, row, col):
+        if row % 2 == 0 and col % 2 == 0:
+            return self.cell_links[self.cell_index(row, col)]
+        elif row % 2 == 1 and col % 2 == 1:
+            return self.dot_links[self.dot_index(row, col)]
+
         count = 0
         for r in range(row - 1, row + 2):
             for c in range(col - 1, col + 2):
@@ -610,7 +1848,27 @@ class Puzzle:
         return count
 
 
+    def count_adjacent_edges(self, row, col):
+        '''
+        Returns (links, unknowns) for the four edges around the specified
+        dot or cell, from the counts that set_board() keeps.
+        '''
+        if row % 2 == 0:
+            i = self.cell_index(row, col)
+            links = self.cell_links[i]
+            return (links, 4 - links - self.cell_xes[i])
+        else:
+            i = self.dot_index(row, col)
+            links = self.dot_links[i]
+            return (links, 4 - links - self.dot_xes[i])
+
+
     def count_adjacent_xes(self, row, col):
+        if row % 2 == 0 and col % 2 == 0:
+            return self.cell_xes[self.cell_index(row, col)]
+        elif row % 2 == 1 and col % 2 == 1:
+            return self.dot_xes[self.dot_index(row, col)]
+
         count = 0
         for r in range(row - 1, row + 2):
             for c in range(col - 1, col + 2):
@@ -618,26 +1876,181 @@ class Puzzle:
                     count += 1
         return count
 
-    def cond_set_x(self, row, col):
-        if self.get_board(row, col) == ' ':
-            self.set_board(row, col, 'x')
-            self.set_changed()
-            self.change_count += 1
+    def is_lone_loop(self, row1, col1, row2, col2):
+        '''
+        Reports whether a loop running just around the rectangle of cells
+        from (row1, col1) to (row2, col2) would satisfy every clue, making
+        it a solution on its own.  Some rules rely on the loop not fitting
+        that tightly around their cells, which only holds if it doesn't.
+        '''
+        key = (row1, col1, row2, col2)
+        result = self.lone_loops.get(key)
+        if result is not None:
+            return result
+
+        result = True
+        for (cell, value) in enumerate(self.clues):
+            if value == BLANK_CODE:
+                continue
 
-    def cond_set_link(self, row, col, value):
-        assert(value in ['-', '|'])
+            r = 2 * (cell // self.cols) + 2
+            c = 2 * (cell % self.cols) + 2
+            in_rows = row1 <= r <= row2
+            in_cols = col1 <= c <= col2
 
-        if self.get_board(row, col) == ' ':
-            if value == '-':
-                assert(self.get_board(row, col - 1) == '.' and \
-                       self.get_board(row, col + 1) == '.')
+            if in_rows and in_cols:
+                links = (r == row1) + (r == row2) + (c == col1) + (c == col2)
             else:
-                assert(self.get_board(row - 1, col) == '.' and \
-                       self.get_board(row + 1, col) == '.')
+                # A cell beside the rectangle shares one edge with the loop.
+                links = (in_cols and r in (row1 - 2, row2 + 2)) or \
+                        (in_rows and c in (col1 - 2, col2 + 2))
 
-            self.set_board(row, col, value)
-            self.set_changed()
+            if value - ZERO_CODE != links:
+                result = False
+                break
+
+        self.lone_loops[key] = result
+        return result
+
+    def add_clue(self, row, col, value):
+        '''
+        Puts a clue, one of the characters '0' to '3', into the blank cell
+        at the specified position, and queues up the cells around it, since
+        their rules also look at the clues of their neighbors.  Like every
+        other change, the clue is recorded on the undo trail, so that the
+        puzzle generator can try out sets of clues on the same board.
+        '''
+        code = ord(value)
+        self.store(self.board, row * self.board_width + col, code)
+
+        cell = self.cell_index(row, col)
+        self.store(self.__dict__, 'clues', self.clues[:cell] + bytes([code]) +
+                   self.clues[cell + 1:])
+        self.store(self.__dict__, 'lone_loops', {})
+
+        for r in range(max(2, row - 2), min(2 * self.rows, row + 2) + 1, 2):
+            for c in range(max(2, col - 2), min(2 * self.cols, col + 2) + 1, 2):
+                self.queue_position(r, c)
+
+    def cell_values(self):
+        '''
+        Returns the clues of the puzzle as a list of strings, one per row,
+        in the form that the constructor takes.
+        '''
+        text = self.clues.decode('ascii')
+        return [text[r * self.cols:(r + 1) * self.cols]
+                for r in range(self.rows)]
+
+    def queue_position(self, row, col):
+        '''
+        Adds the specified cell or dot to the propagation worklist, unless
+        it is already queued.
+        '''
+        index = row * self.board_width + col
+        if not self.queued[index]:
+            self.queued[index] = 1
+            self.pending.append((row, col))
+
+
+    def queue_edge_neighbors(self, row, col):
+        '''
+        Queues up every cell and dot whose rules can see the edge at the
+        specified position.  This is the two dots at the ends of the edge,
+        and the cells around those two dots, since no cell rule looks
+        further than the edges touching the corners of its cell.
+        '''
+        if row % 2 == 1:
+            dots = [(row, col - 1), (row, col + 1)]
+        else:
+            dots = [(row - 1, col), (row + 1, col)]
+
+        for (dot_row, dot_col) in dots:
+            self.queue_position(dot_row, dot_col)
+
+            for r in [dot_row - 1, dot_row + 1]:
+                if r < 2 or r > 2 * self.rows:
+                    continue
+
+                for c in [dot_col - 1, dot_col + 1]:
+                    if c >= 2 and c <= 2 * self.cols:
+                        self.queue_position(r, c)
+
+
+    def queue_path_dot(self, dot):
+        '''
+        Queues up the dots that must be re-checked by the "avoid multiple
+        loops" rule when the path of the specified dot number changes.
+        That rule compares each dot with the dots below it and to the right
+        of it, so the dots above and to the left of this dot are queued as
+        well.
+        '''
+        (row, col) = self.dot_position(dot)
+        self.queue_position(row, col)
+        if row > 1:
+            self.queue_position(row - 2, col)
+        if col > 1:
+            self.queue_position(row, col - 2)
+
+
+    def check_dead_ends(self, index):
+        '''
+        Raises a MoveError if either dot at the ends of the edge at the
+        specified board index, which has just been set, is now the end of
+        a path with x-es on all its other sides.  Such a path can't be
+        part of the loop, and none of the rules would notice, since there
+        is no edge left for them to set.
+        '''
+        tables = self.tables
+        edge = tables.edge_ids[index]
+        for dot in tables.edge_dots[2 * edge:2 * edge + 2]:
+            if self.dot_xes[dot] == 3 and self.dot_links[dot] == 1:
+                raise MoveError("Dot %s is a dead end" %
+                                str(self.dot_position(dot)))
+
+    def join_edge_colors(self, index, link):
+        '''
+        Joins the color classes of the cells on either side of the edge at
+        the specified board index, which has just been set:  an 'x' means
+        that they are the same color, and a link that they differ.
+        '''
+        edge = self.tables.edge_ids[index]
+        self.join_colors(self.tables.edge_colors[2 * edge],
+                         self.tables.edge_colors[2 * edge + 1], link)
+
+    def cond_set_x(self, row, col):
+        if CHECK_BOUNDS:
+            self.check_position(row, col)
+
+        index = row * self.board_width + col
+        if self.board[index] == BLANK_CODE:
+            self.set_code(index, X_CODE)
+            self.set_changed()
             self.change_count += 1
+            self.queue_edge_neighbors(row, col)
+            self.check_dead_ends(index)
+            self.join_edge_colors(index, False)
+
+    def cond_set_link(self, row, col, value):
+        if CHECK_BOUNDS:
+            self.check_position(row, col)
+            assert(value in ['-', '|'])
+
+        index = row * self.board_width + col
+        if self.board[index] == BLANK_CODE:
+            if CHECK_BOUNDS:
+                if value == '-':
+                    assert(self.get_board(row, col - 1) == '.' and \
+                           self.get_board(row, col + 1) == '.')
+                else:
+                    assert(self.get_board(row - 1, col) == '.' and \
+                           self.get_board(row + 1, col) == '.')
+
+            self.set_code(index, ord(value))
+            self.set_changed()
+            self.change_count += 1
+            self.queue_edge_neighbors(row, col)
+            self.check_dead_ends(index)
+            self.join_edge_colors(index, True)
 
             # Update the path information!
 
@@ -648,64 +2061,156 @@ class Puzzle:
                 dot1 = (row - 1, col)
                 dot2 = (row + 1, col)
 
-            if dot1 not in self.dot_paths and dot2 not in self.dot_paths:
-                # Easy case:  neither dot is in a path!
+            self.link_dots(dot1, dot2)
 
-                path_id = self.next_path_id
-                self.next_path_id += 1
-                #print("Creating new path with ID %d" % path_id)
 
-                self.dot_paths[dot1] = path_id
-                self.dot_paths[dot2] = path_id
+    def cell_index(self, row, col):
+        '''
+        Returns the number of the cell at the specified board position.
+        The cells are numbered row by row, starting from 0.
+        '''
+        return (row // 2 - 1) * self.cols + col // 2 - 1
 
-                self.path_dots[path_id] = [dot1, dot2]
 
-            elif dot1 not in self.dot_paths:
-                # dot2 is in an existing path.
+    def dot_index(self, row, col):
+        '''
+        Returns the number of the dot at the specified board position.  The
+        dots are numbered row by row, starting from 0.
+        '''
+        return (row // 2) * (self.cols + 1) + col // 2
+
 
-                path_id = self.dot_paths[dot2]
-                #print("Adding dot1 to dot2's path with ID %d" % path_id)
+    def dot_position(self, dot):
+        '''
+        Returns the board position of the specified dot number, as a
+        (row, col) tuple.
+        '''
+        return (2 * (dot // (self.cols + 1)) + 1, 2 * (dot % (self.cols + 1)) + 1)
 
-                self.dot_paths[dot1] = path_id
-                self.path_dots[path_id].append(dot1)
 
-            elif dot2 not in self.dot_paths:
-                # dot1 is in an existing path.
+    def find_path(self, dot):
+        '''
+        Returns the root of the path that the specified dot number is part
+        of, or -1 if the dot isn't on any path.  Dots on the same path
+        always report the same root.
+        '''
+        parent = self.dot_parent
+        root = parent[dot]
+        if root < 0:
+            return -1
 
-                path_id = self.dot_paths[dot1]
-                #print("Adding dot2 to dot1's path with ID %d" % path_id)
+        while parent[root] != root:
+            root = parent[root]
 
-                self.dot_paths[dot2] = path_id
-                self.path_dots[path_id].append(dot2)
+        # Path compression:  point every dot we passed directly at the root.
+        while parent[dot] != root:
+            next_dot = parent[dot]
+            self.store(parent, dot, root)
+            dot = next_dot
 
+        return root
+
+
+    def link_dots(self, dot1, dot2):
+        '''
+        Updates the path information for a new link between the two
+        specified dots, which are given as (row, col) tuples.  A MoveError
+        is raised if the link would close a loop while other paths remain,
+        or would give a dot more than two links.
+        '''
+        d1 = self.dot_index(*dot1)
+        d2 = self.dot_index(*dot2)
+
+        path1 = self.find_path(d1)
+        path2 = self.find_path(d2)
+
+        if (path1 >= 0 and self.path_end[d1] < 0) or \
+           (path2 >= 0 and self.path_end[d2] < 0):
+            # One of the dots is already in the middle of a path.
+            raise MoveError("Too many links at dots %s and %s" % (dot1, dot2))
+
+        if path1 < 0 and path2 < 0:
+            # Easy case:  neither dot is in a path!
+
+            self.store(self.dot_parent, d1, d1)
+            self.store(self.dot_parent, d2, d1)
+            self.store(self.dot_size, d1, 2)
+            self.store(self.path_end, d1, d2)
+            self.store(self.path_end, d2, d1)
+            self.store(self.__dict__, 'num_paths', self.num_paths + 1)
+
+            self.queue_path_dot(d1)
+            self.queue_path_dot(d2)
+
+            if self.num_paths == 2:
+                # The "avoid multiple loops" rule ignores the board while
+                # there is only one path, so the ends of the other path
+                # must be checked again now.
+                for dot in range(len(self.path_end)):
+                    if self.path_end[dot] >= 0 and dot != d1 and dot != d2:
+                        self.queue_path_dot(dot)
+
+        elif path1 < 0 or path2 < 0:
+            # One dot is at the end of an existing path, and the other dot
+            # extends that path.
+
+            if path1 < 0:
+                (new_dot, old_end, path) = (d1, d2, path2)
             else:
-                # Both dots are in paths
+                (new_dot, old_end, path) = (d2, d1, path1)
 
-                dot1_path_id = self.dot_paths[dot1]
-                dot2_path_id = self.dot_paths[dot2]
+            other_end = self.path_end[old_end]
 
-                #print("Dot 1:  %s\t\tDot 2:  %s" % (dot1, dot2))
+            self.store(self.dot_parent, new_dot, path)
+            self.store(self.dot_size, path, self.dot_size[path] + 1)
+            self.store(self.path_end, old_end, -1)
+            self.store(self.path_end, new_dot, other_end)
+            self.store(self.path_end, other_end, new_dot)
 
-                if dot1_path_id == dot2_path_id:
-                    if len(self.path_dots) > 1:
-                        # self.pretty_print()
-                        raise MoveError("Can't join dots %s and %s" % (dot1, dot2) )
-                    else:
-                        # In this situation we are joining two ends of a single
-                        # path together.  Thus, all path-dots are already in the path.
-                        return
+            self.queue_path_dot(new_dot)
 
-                #print("Adding dot2's path (ID %d) to dot1's path (ID %d)" % (dot2_path_id, dot1_path_id))
+        elif path1 == path2:
+            # Both dots are the ends of the same path.
 
-                # Update dot2's path to be part of dot1's path
+            if self.num_paths > 1:
+                # self.pretty_print()
+                raise MoveError("Can't join dots %s and %s" % (dot1, dot2) )
 
-                dot2_path_dots = self.path_dots[dot2_path_id]
-                #print(dot2_path_dots)
-                for dot in dot2_path_dots:
-                    self.dot_paths[dot] = dot1_path_id
+            # In this situation we are joining two ends of a single path
+            # together, which closes the loop.  Every other edge must then
+            # be an 'x', so the loop has to meet every clue already.
+            cell = self.find_unmet_clue()
+            if cell >= 0:
+                raise MoveError("Closing the loop at dots %s and %s leaves "
+                                "cell %d without enough links" %
+                                (dot1, dot2, cell))
 
-                self.path_dots[dot1_path_id].extend(dot2_path_dots)
-                del self.path_dots[dot2_path_id]
+            self.store(self.path_end, d1, -1)
+            self.store(self.path_end, d2, -1)
+            self.store(self.__dict__, 'loop_closed', True)
+
+        else:
+            # Both dots are at the ends of different paths.  Join the paths
+            # together, hanging the smaller path off the larger one.
+
+            end1 = self.path_end[d1]
+            end2 = self.path_end[d2]
+
+            if self.dot_size[path1] < self.dot_size[path2]:
+                (path1, path2) = (path2, path1)
+
+            self.store(self.dot_parent, path2, path1)
+            self.store(self.dot_size, path1,
+                       self.dot_size[path1] + self.dot_size[path2])
+            self.store(self.__dict__, 'num_paths', self.num_paths - 1)
+
+            self.store(self.path_end, d1, -1)
+            self.store(self.path_end, d2, -1)
+            self.store(self.path_end, end1, end2)
+            self.store(self.path_end, end2, end1)
+
+            self.queue_path_dot(end1)
+            self.queue_path_dot(end2)
 
     def fill_in_xes(self):
         self.iter_cells(cellfunc_fill_in_xes)
@@ -729,6 +2234,10 @@ class Puzzle:
     def handle_closed_corners(self):
         self.iter_cells(cellfunc_handle_closed_corners)
 
+    def apply_coloring(self):
+        self.iter_cells(cellfunc_color_clue)
+        self.iter_dots(dotfunc_color_dot)
+
     def handle_diagonal_chains(self):
         '''
         Attempts to identify [3, 2, 2, ..., 2, 3] diagonal chains, which
@@ -738,45 +2247,29 @@ class Puzzle:
 
     def check_row_links(self):
         for r in range(2, 2 * self.rows + 1, 2):
-            num_links = 0
-            num_unknowns = 0
-            unknown = None
+            # The vertical edges along this row of cells.
+            row_start = r * self.board_width
+            edges = self.board[row_start + 1:row_start + 2 * self.cols + 2:2]
 
-            for c in range(1, 2 * self.cols + 2, 2):
-                val = self.get_board(r, c)
-                if val == '|':
-                    num_links += 1
-                elif val == ' ':
-                    num_unknowns += 1
-                    if num_unknowns == 1:
-                        unknown = (r, c)
-
-            if num_unknowns == 1:
-                r, c = unknown
+            if edges.count(BLANK_CODE) == 1:
+                num_links = edges.count(V_LINK_CODE)
+                c = 1 + 2 * edges.index(BLANK_CODE)
                 if num_links % 2 == 0:
-                    print("FOUND ROW LINK, SETTING TO X")
+                    log.log(TRACE, "FOUND ROW LINK, SETTING TO X")
                     self.cond_set_x(r, c)
                 else:
-                    print("FOUND ROW LINK, SETTING TO |")
+                    log.log(TRACE, "FOUND ROW LINK, SETTING TO |")
                     self.cond_set_link(r, c, '|')
 
     def check_col_links(self):
+        width = self.board_width
         for c in range(2, 2 * self.cols + 1, 2):
-            num_links = 0
-            num_unknowns = 0
-            unknown = None
+            # The horizontal edges down this column of cells.
+            edges = self.board[width + c:(2 * self.rows + 2) * width:2 * width]
 
-            for r in range(1, 2 * self.rows + 2, 2):
-                val = self.get_board(r, c)
-                if val == '-':
-                    num_links += 1
-                elif val == ' ':
-                    num_unknowns += 1
-                    if num_unknowns == 1:
-                        unknown = (r, c)
-
-            if num_unknowns == 1:
-                r, c = unknown
+            if edges.count(BLANK_CODE) == 1:
+                num_links = edges.count(H_LINK_CODE)
+                r = 1 + 2 * edges.index(BLANK_CODE)
                 if num_links % 2 == 0:
                     #print("FOUND COLUMN LINK, SETTING TO X")
                     self.cond_set_x(r, c)
@@ -785,7 +2278,102 @@ class Puzzle:
                     self.cond_set_link(r, c, '-')
 
 
-    def iter_solve(self, verbose=False):
+    def run_worklist(self):
+        '''
+        Applies the cell and dot rules to the positions in the worklist,
+        until the worklist is empty.  Setting an edge queues up the
+        positions around it, so this stops at the same fixed point that
+        repeated sweeps over the whole board would reach.  Returns True if
+        any edges were set.
+
+        If the puzzle is using the vectorized rules, those rules are left
+        out of the worklist, and are applied to the whole board each time
+        the worklist empties, until neither makes any more changes.
+
+        The puzzle's RuleScheduler picks the rules for each position and
+        the order to apply them in, and may defer some of them until the
+        worklist is empty.
+        '''
+        start_count = self.change_count
+        timing = self.rule_stats is not None
+
+        if self.vectorized and numpy is not None:
+            cell_rules = SCALAR_CELL_RULES
+            dot_rules = SCALAR_DOT_RULES
+        else:
+            cell_rules = CELL_RULES
+            dot_rules = DOT_RULES
+
+        scheduler = self.scheduler
+        if scheduler is None or scheduler.cell_rules is not cell_rules:
+            scheduler = RuleScheduler(cell_rules, dot_rules, len(self.board))
+            self.scheduler = scheduler
+
+        sampling = scheduler.start_run()
+
+        board = self.board
+        width = self.board_width
+        pending = self.pending
+        queued = self.queued
+        clue_rules = scheduler.clue_rules
+        clue_deferred = scheduler.clue_deferred
+        dot_active = scheduler.dot_active
+        dot_deferred = scheduler.dot_deferred
+        deferred_flags = scheduler.deferred_flags
+
+        while True:
+            while pending:
+                (r, c) = pending.popleft()
+                i = r * width + c
+                queued[i] = 0
+
+                if r % 2 == 0:
+                    rules = clue_rules[board[i]]
+                    deferred = clue_deferred[board[i]]
+                else:
+                    rules = dot_active
+                    deferred = dot_deferred
+
+                if timing:
+                    for rule in rules:
+                        self.apply_rule(rule.__name__, 1, rule, self, r, c)
+                elif sampling:
+                    scheduler.sample(self, rules, r, c)
+                else:
+                    for rule in rules:
+                        rule(self, r, c)
+
+                if deferred and not deferred_flags[i]:
+                    deferred_flags[i] = 1
+                    scheduler.deferred.append((r, c))
+
+            if cell_rules is not CELL_RULES and \
+               self.apply_rule('apply_vectorized_rules', self.num_positions,
+                               apply_vectorized_rules, self):
+                continue
+
+            if not scheduler.run_deferred(self, sampling):
+                break
+
+        if sampling:
+            scheduler.update()
+
+        return self.change_count != start_count
+
+
+    def clear_worklist(self):
+        '''
+        Empties the worklist without applying any rules.
+        '''
+        for (r, c) in self.pending:
+            self.queued[r * self.board_width + c] = 0
+        self.pending.clear()
+
+        if self.scheduler is not None:
+            self.scheduler.take_deferred(self.board_width)
+
+
+    def iter_solve(self, verbose=False, worklist=True):
         '''
         Attempt to solve the puzzle by iteratively applying the rules
         encoded in the various helper functions.  If we make it through
@@ -793,8 +2381,27 @@ class Puzzle:
         could signal that we found the solution, or that we reached the
         extent of what we can solve with the simple rules, or that we
         reached an invalid board configuration.
+
+        If worklist is True then the basic rules are only re-checked at
+        the positions around edges that have changed; otherwise every
+        pass sweeps the rules over the entire board.  Both modes reach the
+        same fixed point.  The worklist mode can also apply some of the
+        rules with NumPy (see the vectorized attribute).
+
+        The rules that made changes on each pass are logged at the TRACE
+        level, or at DEBUG if verbose is True.
         '''
 
+        if worklist:
+            self.iter_solve_worklist(verbose)
+            return
+
+        if verbose:
+            level = logging.DEBUG
+        else:
+            level = TRACE
+        logging_passes = log.isEnabledFor(level)
+
         operations = [
             (self.handle_closed_corners, "Handling closed corners"),
             (self.fill_in_xes, "Filling in x-es based on cell values"),
@@ -803,11 +2410,13 @@ class Puzzle:
             (self.handle_ones, "Filling in x-es based on adjacent 1-cells"),
             (self.update_dot_state, "Filling in x-es and links based on state adjacent to dots"),
             (self.avoid_multiple_loops, "Avoid multiple loops"),
+            (self.apply_coloring, "Coloring cells inside and outside the loop"),
         ]
 
         iter = 0
         while True:
             iter += 1
+            self.passes += 1
             made_change = False
 
             # Do basic operations
@@ -815,8 +2424,8 @@ class Puzzle:
                 self.set_changed(False)
                 op[0]()
                 if self.is_changed():
-                    if verbose:
-                        print("%d:  %s" % (iter, op[1]))
+                    if logging_passes:
+                        log.log(level, "%d:  %s", iter, op[1])
                         #p.pretty_print()
                     made_change = True
 
@@ -826,127 +2435,1321 @@ class Puzzle:
                 self.set_changed(False)
                 self.handle_diagonal_chains()
                 if self.is_changed():
-                    if verbose:
-                        print("%d:  (ADV) Handle diagonal chains" % iter)
+                    if logging_passes:
+                        log.log(level, "%d:  (ADV) Handle diagonal chains",
+                                iter)
                     made_change = True
 
                 self.set_changed(False)
-                self.check_row_links()
-                self.check_col_links()
+                self.apply_rule('check_row_links', self.rows,
+                                self.check_row_links)
+                self.apply_rule('check_col_links', self.cols,
+                                self.check_col_links)
                 if self.is_changed():
-                    if verbose:
-                        print("%d:  (ADV) Check row/column links" % iter)
+                    if logging_passes:
+                        log.log(level, "%d:  (ADV) Check row/column links",
+                                iter)
                     made_change = True
 
-            if not self.can_solve():
-                print("Cannot solve this board:  invalid configuration reached.")
+            if not self.apply_rule('can_solve', self.num_positions,
+                                   self.can_solve):
+                log.log(TRACE, "Cannot solve this board:  invalid "
+                        "configuration reached.")
                 break
 
             if not made_change:
+                # Every position has been checked against the current
+                # board, so nothing needs to stay in the worklist.
+                self.clear_worklist()
                 break
 
-        
-    def dots_are_connected(self, dot1, dot2):
-        if dot1 in self.dot_paths and dot2 in self.dot_paths:
-            dot1_path_id = self.dot_paths[dot1]
-            dot2_path_id = self.dot_paths[dot2]
 
-            return dot1_path_id == dot2_path_id
+    def iter_solve_worklist(self, verbose=False):
+        '''
+        The event-driven version of iter_solve().  The basic rules are
+        applied from the worklist until nothing changes, and then the more
+        compute-intensive rules are run over the whole board.  If those
+        set any edges, the worklist has been refilled and we go around
+        again.
+        '''
+
+        if verbose:
+            level = logging.DEBUG
         else:
-            return False
+            level = TRACE
+        logging_passes = log.isEnabledFor(level)
+
+        iter = 0
+        while True:
+            iter += 1
+            self.passes += 1
+
+            if self.run_worklist() and logging_passes:
+                log.log(level, "%d:  Applied basic rules to changed positions",
+                        iter)
+
+            made_change = False
+
+            self.set_changed(False)
+            self.handle_diagonal_chains()
+            if self.is_changed():
+                if logging_passes:
+                    log.log(level, "%d:  (ADV) Handle diagonal chains", iter)
+                made_change = True
+
+            self.set_changed(False)
+            self.apply_rule('check_row_links', self.rows,
+                            self.check_row_links)
+            self.apply_rule('check_col_links', self.cols,
+                            self.check_col_links)
+            if self.is_changed():
+                if logging_passes:
+                    log.log(level, "%d:  (ADV) Check row/column links", iter)
+                made_change = True
+
+            if not self.apply_rule('can_solve', self.num_positions,
+                                   self.can_solve):
+                log.log(TRACE, "Cannot solve this board:  invalid "
+                        "configuration reached.")
+                break
+
+            if not made_change:
+                break
+
+
+    def dots_are_connected(self, dot1, dot2):
+        '''
+        Reports whether the two specified board positions are dots on the
+        same path.  Positions that aren't dots, such as edges, always give
+        False.
+        '''
+        for (r, c) in [dot1, dot2]:
+            if r % 2 == 0 or c % 2 == 0:
+                # Not a dot at all.
+                return False
+
+        path1 = self.find_path(self.dot_index(*dot1))
+        return path1 >= 0 and path1 == self.find_path(self.dot_index(*dot2))
 
 
     def score_move(self, cell_r, cell_c):
         score = 0
-        cellval = self.get_board(cell_r, cell_c)
-        if cellval in ['0', '1', '2', '3']:
-            cellval = int(cellval)
-            links = self.count_adjacent_links(cell_r, cell_c)
+        cellval = self.get_code(cell_r, cell_c)
+        if ZERO_CODE <= cellval <= THREE_CODE:
+            cellval -= ZERO_CODE
+            links = self.cell_links[self.cell_index(cell_r, cell_c)]
 
             if cellval == links:
-                print("UNEXPECTED:  can't add another link!")
-                score = -10
+                log.debug("UNEXPECTED:  can't add another link!")
 
             score = 5 - cellval + links
 
         return score
 
     
-    def enumerate_moves(self):
+    def enumerate_moves(self, first_dot_only=False):
+        '''
+        Returns the moves that extend a path from a dot with one link,
+        sorted by score.  Moves that would join the path back onto itself
+        are left out, since they would close a loop.  If first_dot_only is
+        True then only the moves from the first such dot are returned.
+
+        The list is empty when no dot has exactly one link, for example
+        before any path has been started, so it doesn't always offer a
+        move even though the puzzle isn't finished; a complete search
+        needs another way to pick a move then, such as find_unknown_edge().
+        '''
         moves = set()
         for r in range(1, 2 * self.rows + 2, 2):
+            if first_dot_only and len(moves) > 0:
+                break
+
             for c in range(1, 2 * self.cols + 2, 2):
+                if first_dot_only and len(moves) > 0:
+                    break
+
                 if self.count_adjacent_links(r, c) == 1:
-                    # Construct a tuple so we can look up in the dot-maps whether
-                    # two dots are already connected by another line.
+                    # Skip the edges whose far dot is already on this path,
+                    # since linking to it would close the path into a loop.
                     dot = (r, c)
                     score = 0
 
-                    if self.get_board(r, c-1) == ' ' and \
-                       not self.dots_are_connected(dot, (r, c-1)):
+                    if self.get_code(r, c-1) == BLANK_CODE and \
+                       not self.dots_are_connected(dot, (r, c-2)):
                         score = self.score_move(r-1, c-1) + \
                                 self.score_move(r+1,c-1)
                         moves.add( (r, c-1, '-', score) )
 
-                    if self.get_board(r, c+1) == ' ' and \
-                       not self.dots_are_connected(dot, (r, c+1)):
+                    if self.get_code(r, c+1) == BLANK_CODE and \
+                       not self.dots_are_connected(dot, (r, c+2)):
                         score = self.score_move(r-1, c+1) + \
                                 self.score_move(r+1,c+1)
                         moves.add( (r, c+1, '-', score) )
 
-                    if self.get_board(r-1, c) == ' ' and \
-                       not self.dots_are_connected(dot, (r-1, c)):
+                    if self.get_code(r-1, c) == BLANK_CODE and \
+                       not self.dots_are_connected(dot, (r-2, c)):
                         score = self.score_move(r-1, c-1) + \
                                 self.score_move(r-1,c+1)
                         moves.add( (r-1, c, '|', score) )
 
-                    if self.get_board(r+1, c) == ' ' and \
-                       not self.dots_are_connected(dot, (r+1, c)):
+                    if self.get_code(r+1, c) == BLANK_CODE and \
+                       not self.dots_are_connected(dot, (r+2, c)):
                         score = self.score_move(r+1, c-1) + \
                                 self.score_move(r+1,c+1)
                         moves.add( (r+1, c, '|', score) )
 
         moves = list(moves)
 
+        # Sort by position as well as score, so that the order doesn't
+        # depend on how the set happened to hash the moves.
         #moves.sort(lambda m1, m2: m2[3] - m1[3])
-        moves.sort(key=lambda m:  m[3])
+        moves.sort(key=lambda m:  (m[3], m[0], m[1]))
 
         return moves
         
+    def find_unknown_edge(self):
+        '''
+        Returns the first edge on the board that is neither a link nor an
+        'x', as a (row, col, link) tuple where link is the link character
+        for that edge.  Returns None if every edge is known.
+        '''
+        for r in range(1, 2 * self.rows + 2):
+            for c in range(1 + r % 2, 2 * self.cols + 2, 2):
+                if self.get_code(r, c) == BLANK_CODE:
+                    if r % 2 == 1:
+                        return (r, c, '-')
+                    else:
+                        return (r, c, '|')
+
+        return None
+
+
     def apply_move(self, move):
-        self.cond_set_link(move[0], move[1], move[2])
+        if move[2] == 'x':
+            self.cond_set_x(move[0], move[1])
+        else:
+            self.cond_set_link(move[0], move[1], move[2])
+
 
+# The characters that can appear in the rows of a puzzle file.
+PUZZLE_CHARS = ' 0123'
 
-def load_puzzle(filename):
+# The first two bytes of a gzip stream.
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_lines(filename):
+    '''
+    Opens a puzzle file for reading, and returns a pair (lines, close),
+    where lines iterates over the lines of the file as bytes and close()
+    closes it.  A file ending in .gz, or starting like a gzip stream, is
+    decompressed as it is read.  A regular file is memory-mapped, so that
+    its lines are read straight out of the page cache; pipes and other
+    files that can't be mapped are read as usual.
     '''
-    Loads a puzzle from the simple text format:
+    f = open(filename, 'rb')
+    try:
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # An empty file can't be mapped, nor can a pipe.
+        source = f
+
+    if source is f:
+        magic = f.peek(2)[:2]
+    else:
+        magic = source[:2]
+
+    if filename.endswith('.gz') or magic == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=source)
+        lines = iter(stream)
+    else:
+        stream = None
+        lines = iter(source.readline, b'')
+
+    def close():
+        if stream is not None:
+            stream.close()
+        if source is not f:
+            source.close()
+        f.close()
+
+    return (lines, close)
+
+
+def parse_row(line, cols, where):
+    '''
+    Parses one row of a puzzle file, returning a string of exactly cols
+    characters.  Only the line ending is removed, so blank cells at the
+    start of the row are kept.  A row that is short, e.g. because an
+    editor trimmed its trailing spaces or the file has no final newline,
+    is padded out with blank cells, and spaces past the end of the row are
+    ignored.  Any other text that doesn't fit the row is an error; where
+    says which line of which file it was on, for the error message.
+    '''
+    row = line.rstrip('\r\n')
+    if len(row) > cols:
+        if row[cols:].strip() != '':
+            raise ValueError('%s:  row has more than %d cells: %r' %
+                             (where, cols, row))
+        row = row[:cols]
+
+    for ch in row:
+        if ch not in PUZZLE_CHARS:
+            raise ValueError('%s:  invalid cell %r in row %r' %
+                             (where, ch, row))
 
-    [rows] [cols]
+    return row.ljust(cols)
+
+
+def iter_puzzle_data(filename):
+    '''
+    Generates the puzzles in a puzzle file, one at a time, without reading
+    the rest of the file.  A puzzle file holds any number of puzzles one
+    after the other, each in the simple text format:
+
+    [rows] [cols] [optional name]
     [row 0 data]
     [row 1 data]
     ...
+
+    Blank lines and lines starting with '#' may come between puzzles, but
+    not inside them, since a row of blank cells looks just like a blank
+    line.  Each puzzle is generated as a tuple (name, rows, cols,
+    cell_values), where name is None if the puzzle doesn't have one.  See
+    open_lines() for the files that can be read.
+    '''
+    (lines, close) = open_lines(filename)
+    try:
+        line_num = 0
+        for line in lines:
+            line_num += 1
+            header = line.decode('ascii', 'replace').strip()
+            if header == '' or header.startswith('#'):
+                continue
+
+            where = '%s, line %d' % (filename, line_num)
+            dims = header.split(None, 2)
+            try:
+                rows = int(dims[0])
+                cols = int(dims[1])
+            except (IndexError, ValueError):
+                raise ValueError("%s:  expected '[rows] [cols]', found %r" %
+                                 (where, header))
+            if rows < 1 or cols < 1:
+                raise ValueError('%s:  invalid puzzle size %d x %d' %
+                                 (where, rows, cols))
+
+            name = None
+            if len(dims) > 2:
+                name = dims[2]
+
+            cell_values = []
+            for line in lines:
+                line_num += 1
+                where = '%s, line %d' % (filename, line_num)
+                try:
+                    line = line.decode('ascii')
+                except UnicodeDecodeError:
+                    raise ValueError('%s:  row is not ASCII text' % where)
+                cell_values.append(parse_row(line, cols, where))
+                if len(cell_values) == rows:
+                    break
+            else:
+                raise ValueError('%s:  puzzle ends after %d of its %d rows' %
+                                 (filename, len(cell_values), rows))
+
+            yield (name, rows, cols, cell_values)
+
+    finally:
+        close()
+
+
+def iter_puzzles(filename):
+    '''
+    Generates a Puzzle for each puzzle in a puzzle file, in order, reading
+    the file as it goes.  See iter_puzzle_data().
+    '''
+    for (name, rows, cols, cell_values) in iter_puzzle_data(filename):
+        yield Puzzle(rows, cols, cell_values)
+
+
+def load_puzzle(filename, index=0):
+    '''
+    Loads a puzzle from a puzzle file (see iter_puzzle_data()).  If the
+    file holds several puzzles, index picks which of them to load,
+    counting from 0.
     '''
+    count = 0
+    for (name, rows, cols, cell_values) in iter_puzzle_data(filename):
+        if count == index:
+            return Puzzle(rows, cols, cell_values)
+        count += 1
+
+    raise ValueError('%s:  has %d puzzles, so there is no puzzle %d' %
+                     (filename, count, index))
+
+
+class PuzzleWriter:
+    '''
+    Writes puzzles to a puzzle file in the format that iter_puzzle_data()
+    reads, one after the other.  A filename ending in .gz gets a gzip
+    file, and '-' writes to standard output.  Can be used in a with
+    statement, which closes the file at the end.
+    '''
+
+    def __init__(self, filename):
+        if filename == '-':
+            self.f = sys.stdout
+        elif filename.endswith('.gz'):
+            self.f = gzip.open(filename, 'wt', encoding='ascii')
+        else:
+            self.f = open(filename, 'w', encoding='ascii')
+        self.count = 0
+
+    def write(self, rows, cols, cell_values, name=None):
+        '''
+        Writes one puzzle, with the optional name in its header.  Trailing
+        blank cells are written out, so the rows all have cols cells.
+        '''
+        if name is None:
+            self.f.write('%d %d\n' % (rows, cols))
+        else:
+            self.f.write('%d %d %s\n' % (rows, cols, name))
+        for row in cell_values:
+            self.f.write(row.ljust(cols) + '\n')
+        self.count += 1
 
-    f = open(filename)
+    def write_puzzle(self, p, name=None):
+        '''
+        Writes the clues of the Puzzle p.
+        '''
+        self.write(p.rows, p.cols, p.cell_values(), name)
 
-    line = f.readline()
-    dims = line.split()
-    rows = int(dims[0])
-    cols = int(dims[1])
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+        else:
+            self.f.flush()
 
-    cell_values = []
-    for i in range(rows):
-        row_values = f.readline()
-        cell_values.append(row_values[:-1])
+    def __enter__(self):
+        return self
 
-    f.close()
+    def __exit__(self, *exc_info):
+        self.close()
 
-    return Puzzle(rows, cols, cell_values)
 
+class SearchStats:
+    '''
+    Counts the work done while solving a puzzle, so that different search
+    settings can be compared.  A node is one board that the search applied
+    the rules to, including the initial board.
+
+    If a listener is specified, it is called as listener(event, **fields)
+    for each of these search events:
+
+      'node'          - a node was expanded; fields are depth and move
+                        (None for the initial board)
+      'contradiction' - the node at depth can't lead to a solution
+      'solved'        - the node at depth is a solution; nodes is the
+                        number of nodes expanded
+      'failed'        - the search ended without a solution; nodes is the
+                        number of nodes expanded
+
+    The workers of a parallel search don't report their events.
+    '''
+
+    def __init__(self, listener=None):
+        self.nodes = 0
+        self.max_depth = 0
+        self.listener = listener
 
-def solve_puzzle(p):
+    def add_node(self, depth, move=None):
+        self.nodes += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.listener is not None:
+            self.listener('node', depth=depth, move=move)
+
+    def event(self, event, **fields):
+        '''
+        Reports a search event to the listener, if there is one.
+        '''
+        if self.listener is not None:
+            self.listener(event, **fields)
+
+    def merge(self, nodes, max_depth):
+        '''
+        Adds in the work done by another part of the search, such as a
+        worker process of a parallel search.
+        '''
+        self.nodes += nodes
+        if max_depth > self.max_depth:
+            self.max_depth = max_depth
+
+
+class RuleStats:
+    '''
+    Counts the work done by each rule that iter_solve() applies, so that
+    rules that cost more than they find can be spotted.  For each rule,
+    keyed by name, rules holds a list of four counts:
+
+      calls      - the number of times the rule was applied:  once per
+                   position for the rules applied from the worklist, and
+                   once per pass for the rules that cover the whole board
+      time       - the wall time spent in the rule, in seconds
+      positions  - the number of cells, dots, rows or columns looked at
+      edges      - the number of edges that the rule set
+
+    To collect the counts, set a puzzle's rule_stats attribute to a
+    RuleStats object; the rules are only timed while it is set.  Copies
+    of the puzzle made by the random search share the same object, but the
+    workers of a parallel search don't collect any counts.  Timing every
+    rule slows the solver down, so the times are best compared with each
+    other rather than with untimed runs.
+    '''
+
+    def __init__(self):
+        self.rules = {}
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def add(self, name, calls, seconds, positions, edges):
+        counts = self.rules.get(name)
+        if counts is None:
+            self.rules[name] = [calls, seconds, positions, edges]
+        else:
+            counts[0] += calls
+            counts[1] += seconds
+            counts[2] += positions
+            counts[3] += edges
+
+    def merge(self, other):
+        '''
+        Adds in the counts of another RuleStats object, e.g. to total up
+        the counts of several puzzles.
+        '''
+        for (name, counts) in other.rules.items():
+            self.add(name, *counts)
+
+    def as_dict(self):
+        '''
+        Returns the counts as a dictionary that can be saved as JSON.
+        '''
+        return {name: {'calls': calls, 'time': round(seconds, 6),
+                       'positions': positions, 'edges': edges}
+                for (name, (calls, seconds, positions, edges))
+                in self.rules.items()}
+
+    def report(self):
+        '''
+        Returns the counts as a table, one line per rule with the most
+        expensive rules first, giving the time per edge set so that rules
+        that find little for their cost stand out.
+        '''
+        lines = ['%-34s %9s %9s %10s %7s %9s' % ('Rule', 'Calls', 'Time (s)',
+                 'Positions', 'Edges', 'us/edge')]
+
+        by_time = sorted(self.rules.items(), key=lambda item: -item[1][1])
+        for (name, (calls, seconds, positions, edges)) in by_time:
+            if edges > 0:
+                per_edge = '%9.1f' % (1e6 * seconds / edges)
+            else:
+                per_edge = '%9s' % '-'
+            lines.append('%-34s %9d %9.4f %10d %7d %s' %
+                         (name, calls, seconds, positions, edges, per_edge))
+
+        return '\n'.join(lines)
+
+
+def puzzle_from_state(rows, cols, clues, state):
+    '''
+    Recreates a puzzle from its clues (see Puzzle.clues) and a packed
+    state returned by get_state().
+    '''
+    cell_values = [clues[r * cols:(r + 1) * cols].decode('ascii')
+                   for r in range(rows)]
+
+    p = Puzzle(rows, cols, cell_values)
+    p.load_state(state)
+    return p
+
+
+def solve_puzzle(p, worklist=True, in_place=True, seed=None,
+                 heuristic='constrained', stats=None, table_size=100000,
+                 jobs=1, stop=None, listener=None, vectorized=False,
+                 probes=0):
+    '''
+    Solves the puzzle by applying the rules until they stop making progress,
+    and then searching over the possible moves from that point.  The
+    worklist argument selects the propagation mode used by iter_solve().
+    If vectorized is True then the worklist mode applies some of the rules
+    to the whole board at once with NumPy, if it is installed.  If probes
+    is more than 0, then before branching, each node of the search looks
+    ahead on up to that many edge values with probe_edges().
+
+    If in_place is True then a complete depth-first search is done on the
+    puzzle itself, undoing moves when the search backs out of them;
+    otherwise every move is tried on its own copy of the puzzle, and the
+    next board to try is picked at random.  Any random choices are made
+    with a random number generator seeded from the seed argument, so runs
+    with the same seed make the same choices.
+
+    The heuristic argument names the entry in BRANCHING_HEURISTICS that
+    the depth-first search uses to pick the edge to branch on.  If a
+    SearchStats object is passed as stats, it is updated with the work
+    done by the search.  The random search skips boards it has already
+    seen, remembering up to table_size of them.
+
+    If jobs is more than 1, the depth-first search is split up and run
+    on that many worker processes.  This is only supported for the in-place
+    search.
+
+    If stop is specified, it is an object with an is_set() method, such as
+    a threading.Event, that the single-process depth-first search checks
+    now and then; once it is set, the search gives up and returns False.
+
+    Progress is reported through the slsolve logger, and search events are
+    reported to listener if it is specified (see SearchStats).  Returns
+    True if the puzzle was solved, leaving the solution on the puzzle.
+    '''
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1, not %d" % jobs)
+    if jobs > 1 and not in_place:
+        raise ValueError("the random search can't be run on multiple jobs")
+
+    if seed is None:
+        rng = None
+    else:
+        rng = random.Random(seed)
+
+    p.vectorized = vectorized
+    p.probe_limit = probes
+
+    if stats is None:
+        stats = SearchStats(listener)
+    elif listener is not None:
+        stats.listener = listener
+
+    if in_place and jobs > 1:
+        return search_parallel(p, worklist, rng, seed, heuristic, stats,
+                               jobs)
+    elif in_place:
+        branch = BRANCHING_HEURISTICS[heuristic]
+        return search_depth_first(p, worklist, rng, branch, stats, stop)
+    else:
+        table = TranspositionTable(table_size)
+        return search_with_copies(p, worklist, rng or random.Random(), stats,
+                                  table)
+
+
+def order_branches(r, c, value, rng):
+    '''
+    Returns the two moves for branching on the edge at (r, c):  setting it
+    to the link value, and setting it to an 'x'.  The link is tried first,
+    unless rng is specified, in which case the order is random.
+    '''
+    branches = [(r, c, value), (r, c, 'x')]
+    if rng is not None:
+        rng.shuffle(branches)
+
+    return branches
+
+
+def branch_baseline(p, rng=None):
+    '''
+    Branching heuristic that picks one of the ways out of a dot at the end
+    of a path, using the order from enumerate_moves(), or just the first
+    unknown edge if there are no paths.  If rng is specified, the edge is
+    picked at random from the ways out of that dot.  Returns the two moves
+    for the edge, or None if there are no unknown edges left.
+    '''
+    moves = p.enumerate_moves(first_dot_only=True)
+    if len(moves) > 0:
+        if rng is None:
+            (r, c, value, score) = moves[0]
+        else:
+            (r, c, value, score) = rng.choice(moves)
+    else:
+        edge = p.find_unknown_edge()
+        if edge is None:
+            return None
+        (r, c, value) = edge
+
+    return order_branches(r, c, value, rng)
+
+
+def branch_most_constrained(p, rng=None):
+    '''
+    Branching heuristic that picks an unknown edge around the most
+    constrained position on the board.  The positions considered are dots
+    at the end of a path, which need exactly one more link, and numbered
+    cells that still need some links but not all of their unknown edges.
+    The fewer unknown edges such a position has, the fewer ways there are
+    to finish it, so branching there fails or succeeds the soonest.  Ties
+    go to the edge touching the most such positions, then to the edge with
+    the highest score_move() total for the cells on either side of it, and
+    then to the first edge on the board (or a random one, if rng is
+    specified).  Returns the two moves for the edge, or None if there are
+    no unknown edges left.
+
+    The candidates are found by rescanning every dot and cell on the board
+    at each search node, so that nothing has to be kept up to date as the
+    search moves around.  With count_adjacent_edges() this takes around a
+    tenth of the search time on the 15x15 hard puzzles.
+    '''
+    candidates = constrained_edges(p)
+    if len(candidates) == 0:
+        edge = p.find_unknown_edge()
+        if edge is None:
+            return None
+        (r, c, value) = edge
+
+    else:
+        best = min(candidates.values())
+        edges = [e for e in candidates if candidates[e] == best]
+        if len(edges) > 1:
+            edges = best_scoring_edges(p, edges)
+        if rng is None:
+            (r, c) = edges[0]
+        else:
+            (r, c) = rng.choice(edges)
+
+        if r % 2 == 1:
+            value = '-'
+        else:
+            value = '|'
+
+    return order_branches(r, c, value, rng)
+
+
+def constrained_edges(p):
+    '''
+    Finds the unknown edges around the constrained positions on the board:
+    dots at the end of a path, and numbered cells that still need some
+    links but not all of their unknown edges.  Returns a dictionary that
+    maps each such edge (r, c) to a (unknowns, -positions) key, where
+    unknowns is the fewest unknown edges of the positions it touches, and
+    positions is the number of them, so that the most constrained edges
+    have the smallest keys.
+    '''
+    candidates = {}
+
+    def add_candidates(row, col, unknowns):
+        for (r, c) in [(row - 1, col), (row + 1, col),
+                       (row, col - 1), (row, col + 1)]:
+            if p.get_code(r, c) == BLANK_CODE:
+                (best, count) = candidates.get((r, c), (unknowns, 0))
+                candidates[(r, c)] = (min(best, unknowns), count - 1)
+
+    for r in range(1, 2 * p.rows + 2, 2):
+        for c in range(1, 2 * p.cols + 2, 2):
+            (links, unknowns) = p.count_adjacent_edges(r, c)
+            if links == 1:
+                add_candidates(r, c, unknowns)
+
+    for r in range(2, 2 * p.rows + 1, 2):
+        for c in range(2, 2 * p.cols + 1, 2):
+            val = p.get_code(r, c)
+            if val == BLANK_CODE:
+                continue
+
+            (links, unknowns) = p.count_adjacent_edges(r, c)
+            if links < val - ZERO_CODE < links + unknowns:
+                add_candidates(r, c, unknowns)
+
+    return candidates
+
+
+def best_scoring_edges(p, edges):
+    '''
+    Returns the edges with the highest total score_move() for the cells on
+    either side of them, sorted by position.
+    '''
+    scores = {}
+    for (r, c) in edges:
+        if r % 2 == 1:
+            scores[(r, c)] = p.score_move(r - 1, c) + p.score_move(r + 1, c)
+        else:
+            scores[(r, c)] = p.score_move(r, c - 1) + p.score_move(r, c + 1)
+
+    best = max(scores.values())
+    return sorted(e for e in edges if scores[e] == best)
+
+
+# These are the branching heuristics that the depth-first search can use.
+# Each one is called with the puzzle (and an optional random number
+# generator), and returns the pair of moves to branch on.
+BRANCHING_HEURISTICS = {
+    'baseline': branch_baseline,
+    'constrained': branch_most_constrained,
+}
+
+
+def edge_move(p, index, link):
+    '''
+    Returns the move that sets the edge at the board index to a link if
+    link is True, or to an 'x' otherwise.
+    '''
+    (r, c) = divmod(index, p.board_width)
+    if not link:
+        return (r, c, 'x')
+    elif r % 2 == 1:
+        return (r, c, '-')
+    else:
+        return (r, c, '|')
+
+
+def probe_value(p, index, link, worklist):
+    '''
+    Tries one value of the edge at the board index, as a link if link is
+    True or as an 'x' otherwise, and applies the rules.  Returns None if
+    that leads to a contradiction.  Otherwise the result maps every edge
+    that was set, including this one, to True for a link or False for an
+    'x'; these are read off the undo trail, which must be enabled.  The
+    caller backs the probe out with undo(), even if it solved the puzzle,
+    since the search may need the solutions with the other value too.
+    '''
+    mark = p.checkpoint()
+    try:
+        p.apply_move(edge_move(p, index, link))
+        p.iter_solve(worklist=worklist)
+    except MoveError:
+        return None
+
+    if not p.is_solved() and (not p.can_solve() or not p.can_form_loop()):
+        return None
+
+    board = p.board
+    return {key: board[key] != X_CODE
+            for (values, key, value) in p.trail[mark:] if values is board}
+
+
+def probe_edges(p, worklist=True):
+    '''
+    Looks ahead on the edges around the constrained positions on the
+    board (see constrained_edges()), to find edges that can be set without
+    branching.  Each edge is made a link and then an 'x', applying the
+    rules each time.  If one value leads to a contradiction, the edge must
+    have the other one, which is set for good; if both do, MoveError is
+    raised.  If both values work out, any edges that the rules set the
+    same way for both are set as well.
+
+    At most p.probe_limit values are tried, the most constrained edges
+    first, so nothing is done when it is 0.  A value that an earlier probe
+    of the same pass set as a consequence is not tried again, since the
+    probe that set it didn't fail.  If anything was set by the time every
+    edge has been tried, the edges are gone over again while the budget
+    lasts.  The probes are backed out with the undo trail, which is
+    started for the duration if the puzzle doesn't have one.
+
+    Returns the number of edges set, with the rules applied to them; the
+    board may be solved.
+    '''
+    if p.probe_limit == 0 or p.is_solved() or not p.can_solve() or \
+       not p.can_form_loop():
+        return 0
+
+    own_trail = p.trail is None
+    if own_trail:
+        p.start_trail()
+
+    try:
+        return run_probes(p, worklist)
+    finally:
+        if own_trail:
+            p.trail = None
+
+
+def run_probes(p, worklist):
+    '''
+    The main loop of probe_edges().
+    '''
+    board = p.board
+    budget = p.probe_limit
+    found = 0
+    while budget > 0:
+        found_before = found
+
+        # The edge values that the probes of this pass have set.
+        implied = set()
+
+        candidates = constrained_edges(p)
+        for (r, c) in sorted(candidates, key=lambda e: (candidates[e], e)):
+            index = r * p.board_width + c
+            if board[index] != BLANK_CODE:
+                # An edge set earlier in this pass.
+                continue
+            if budget == 0:
+                break
+
+            # The consequences of each value that worked out, and the
+            # value that failed, if either did.
+            outcomes = []
+            failed = None
+            for link in (True, False):
+                if (index, link) in implied:
+                    outcomes.append({})
+                    continue
+
+                budget -= 1
+                p.probes += 1
+                mark = p.checkpoint()
+                consequences = probe_value(p, index, link, worklist)
+                p.undo(mark)
+                if consequences is None:
+                    failed = link
+                    break
+
+                implied.update(consequences.items())
+                outcomes.append(consequences)
+
+            if failed is not None:
+                moves = [edge_move(p, index, not failed)]
+            elif len(outcomes) == 2:
+                (first, second) = outcomes
+                moves = [edge_move(p, key, link)
+                         for (key, link) in first.items()
+                         if second.get(key) == link]
+            else:
+                moves = []
+
+            if len(moves) == 0:
+                continue
+
+            for move in moves:
+                p.apply_move(move)
+            p.iter_solve(worklist=worklist)
+            found += len(moves)
+
+            if p.is_solved():
+                return found
+            if not p.can_solve() or not p.can_form_loop():
+                raise MoveError("Both values of edge %s fail" %
+                                str(divmod(index, p.board_width)))
+
+        if found == found_before:
+            break
+
+    return found
+
+
+def start_search(p, worklist, stats):
+    '''
+    Applies the rules to the initial board, which is the first node of the
+    depth-first searches.  Returns True if that solves the puzzle, False if
+    the puzzle can't be solved, or None if the search has to go on.
+    '''
+    assert p.can_solve(), "solve-puzzle was handed a board it couldn't solve!"
+
+    log.debug("Attempting initial solution.")
+    stats.add_node(1)
+    try:
+        p.iter_solve(worklist=worklist)
+        probe_edges(p, worklist)
+    except MoveError:
+        log.info("Encountered an invalid move.  Couldn't solve puzzle.")
+        stats.event('contradiction', depth=1)
+        stats.event('failed', nodes=stats.nodes)
+        return False
+
+    if p.is_solved():
+        log.info("DEPTH 1:  SOLVED")
+        stats.event('solved', depth=1, nodes=stats.nodes)
+        return True
+
+    if not p.can_solve() or not p.can_form_loop():
+        log.info("Couldn't solve puzzle.")
+        stats.event('contradiction', depth=1)
+        stats.event('failed', nodes=stats.nodes)
+        return False
+
+    return None
+
+
+def search_depth_first(p, worklist, rng, branch, stats, stop=None):
+    '''
+    Depth-first search that branches on one unknown edge at a time:  first
+    the edge is made a link, and if that fails, it is made an 'x'.  Every
+    move is applied to the one puzzle and backed out again using the undo
+    trail, so the memory used grows with the depth of the search rather
+    than with the number of boards waiting to be tried.  Since both values
+    of each edge are tried, the search always finds a solution if there is
+    one.  The branch function is the heuristic that picks each edge to
+    branch on.  The search gives up if the stop Event is set (see
+    run_depth_first()).
+
+    Two boards in different parts of the search always differ on the edge
+    that the search branched on where they split, so this search never
+    reaches the same board twice, and has no use for a transposition table.
+    '''
+    p.start_trail()
+
+    result = start_search(p, worklist, stats)
+    if result is not None:
+        return result
+
+    # Each stack entry is (checkpoint, branches, i_branch), where checkpoint
+    # marks the board at that depth, branches are the two moves for the
+    # edge being branched on, and i_branch is the index of the next move to
+    # try.
+    stack = [(p.checkpoint(), branch(p, rng), 0)]
+
+    status = run_depth_first(p, stack, worklist, rng, branch, stats,
+                             stop=stop)
+    if status == 'solved':
+        log.info("Expanded %d search nodes.", stats.nodes)
+        return True
+
+    elif status == 'stopped':
+        log.info("Gave up after expanding %d search nodes.", stats.nodes)
+    else:
+        log.info("Couldn't solve puzzle after expanding %d search nodes.",
+                 stats.nodes)
+
+    stats.event('failed', nodes=stats.nodes)
+    return False
+
+
+def run_depth_first(p, stack, worklist, rng, branch, stats, node_limit=None,
+                    stop=None, base_depth=1, verbose=True):
+    '''
+    Runs the main loop of the depth-first search on the specified stack
+    (see search_depth_first()), until the puzzle is solved or there are no
+    moves left to try.  Returns 'solved', leaving the solution on the
+    puzzle, or 'failed'.
+
+    If node_limit is specified then the search also stops after expanding
+    that many nodes, and returns 'limit' with the moves that are left to
+    try still on the stack.  If stop is specified, it is an Event that is
+    checked now and then; once it is set, the search returns 'stopped'.
+
+    The depth of the nodes is counted from base_depth, the depth of the
+    board at the bottom of the stack.  If verbose is False then nothing is
+    logged.
+    '''
+    logging_nodes = verbose and log.isEnabledFor(logging.DEBUG)
+
+    nodes = 0
+    while len(stack) > 0:
+        (mark, branches, i_branch) = stack.pop()
+        if branches is None or i_branch == len(branches):
+            # Both values of this edge have failed, so back up a level.
+            continue
+
+        if node_limit is not None and nodes == node_limit:
+            stack.append((mark, branches, i_branch))
+            return 'limit'
+
+        if stop is not None and nodes % 64 == 0 and stop.is_set():
+            return 'stopped'
+
+        stack.append((mark, branches, i_branch + 1))
+        depth = len(stack) + base_depth
+        move = branches[i_branch]
+
+        p.undo(mark)
+        p.clear_changed_count()
+        stats.add_node(depth, move)
+        nodes += 1
+
+        if logging_nodes:
+            log.debug("DEPTH %d:  Branch %d of %d:  %s  Attempting to solve.",
+                      depth, i_branch + 1, len(branches), move)
+
+        try:
+            p.apply_move(move)
+            p.iter_solve(worklist=worklist)
+            probe_edges(p, worklist)
+        except MoveError:
+            if logging_nodes:
+                log.debug("Encountered an invalid move.  Abandoning this path.")
+            stats.event('contradiction', depth=depth)
+            continue
+
+        if p.is_solved():
+            if verbose:
+                log.info("DEPTH %d:  SOLVED", depth)
+            stats.event('solved', depth=depth, nodes=stats.nodes)
+            return 'solved'
+
+        elif not p.can_solve() or not p.can_form_loop():
+            if logging_nodes:
+                log.debug("Couldn't solve this configuration, abandoning.")
+            stats.event('contradiction', depth=depth)
+            continue
+
+        stack.append((p.checkpoint(), branch(p, rng), 0))
+
+    return 'failed'
+
+
+def count_solutions(p, limit=2, worklist=True, seed=None,
+                    heuristic='constrained', stats=None, stop=None,
+                    listener=None, vectorized=False, probes=0):
+    '''
+    Counts the solutions of the puzzle, up to limit of them, for example to
+    check that a puzzle has exactly one solution.  This is the depth-first
+    search of solve_puzzle(), with the same rules and pruning, except that
+    it carries on past each solution until it has found limit solutions or
+    there are no moves left to try.  Every solution is a different board,
+    since boards in different parts of the search differ on the edge the
+    search branched on, so no solution is counted twice.  With the default
+    limit of 2, showing that a puzzle is unique costs the search for its
+    solution plus a search of the rest of the tree.
+
+    The other arguments are the same as for solve_puzzle().  Returns the
+    number of solutions found, which is limit if there may be more, or
+    None if stop was set before the count was finished.  If any solution
+    was found, the first one is left on the puzzle.
+    '''
+    if limit < 1:
+        raise ValueError("limit must be at least 1, not %d" % limit)
+
+    if seed is None:
+        rng = None
+    else:
+        rng = random.Random(seed)
+
+    p.vectorized = vectorized
+    p.probe_limit = probes
+
+    if stats is None:
+        stats = SearchStats(listener)
+    elif listener is not None:
+        stats.listener = listener
+
+    p.start_trail()
+    result = start_search(p, worklist, stats)
+    if result is not None:
+        # If the rules alone solved the puzzle, they did so without making
+        # any guesses, so there is no other solution.
+        return int(result)
+
+    branch = BRANCHING_HEURISTICS[heuristic]
+    root = p.checkpoint()
+    stack = [(root, branch(p, rng), 0)]
+
+    # run_depth_first() leaves the moves it hasn't tried yet on the stack
+    # when it finds a solution, so it can simply be run again to look for
+    # the next one.
+    count = 0
+    first = None
+    while count < limit:
+        status = run_depth_first(p, stack, worklist, rng, branch, stats,
+                                 stop=stop)
+        if status == 'stopped':
+            log.info("Gave up after finding %d solutions in %d search "
+                     "nodes.", count, stats.nodes)
+            return None
+        elif status != 'solved':
+            break
+
+        count += 1
+        if first is None:
+            first = p.get_state()
+
+    log.info("Found %d solutions%s in %d search nodes.", count,
+             " (the limit)" if count == limit else "", stats.nodes)
+
+    if first is not None:
+        p.undo(root)
+        p.load_state(first)
+
+    return count
+
+
+# The Event that tells the worker processes of a parallel search to stop.
+# It is handed to each worker when the worker process starts, along with
+# the parent's CHECK_BOUNDS setting.
+worker_stop = None
+
+
+def init_worker(stop, check_bounds=False):
+    global worker_stop, CHECK_BOUNDS
+    worker_stop = stop
+    CHECK_BOUNDS = check_bounds
+
+
+def solve_subproblem(task, verbose=False):
+    '''
+    Solves one subproblem of a parallel search, usually in a worker
+    process.  The task is a tuple (rows, cols, clues, subproblem,
+    settings), where clues is the puzzle's clues table.  The subproblem
+    is a tuple (state, move, depth):  the packed state from get_state(), the move to apply to it, and the depth in the search of
+    the board that the move makes.  The settings are a (worklist,
+    vectorized, probe_limit, heuristic, seed, node_limit) tuple.  The
+    subproblem is searched depth-first for at most node_limit nodes.
+    Nothing is logged unless verbose is True, so that workers don't print
+    over each other.
+
+    Returns a tuple (status, result, nodes, max_depth), where nodes and
+    max_depth are the number of nodes expanded and the deepest depth
+    reached, and status is one of:
+
+      'solved' - result is the state of the solved board
+      'failed' - the subproblem has no solution; result is None
+      'split'  - the node limit was reached, and result is the list of
+                 subproblems that are still left to search, with the one
+                 to search next at the end
+      'stopped' - another worker found a solution first; result is None
+    '''
+    (rows, cols, clues, subproblem, settings) = task
+    (state, move, depth) = subproblem
+    (worklist, vectorized, probe_limit, heuristic, seed, node_limit) = \
+        settings
+
+    p = puzzle_from_state(rows, cols, clues, state)
+    p.vectorized = vectorized
+    p.probe_limit = probe_limit
+    p.start_trail()
+
+    if seed is None:
+        rng = None
+    else:
+        # Give every subproblem its own, but reproducible, random choices.
+        rng = random.Random(seed ^ p.board_hash)
+
+    stats = SearchStats()
+    stack = [(p.checkpoint(), [move], 0)]
+
+    base_depth = depth - 1
+    status = run_depth_first(p, stack, worklist, rng,
+                             BRANCHING_HEURISTICS[heuristic], stats,
+                             node_limit, worker_stop, base_depth, verbose)
+
+    if status == 'solved':
+        return ('solved', p.get_state(), stats.nodes, stats.max_depth)
+
+    elif status == 'limit':
+        # Turn the moves left on the stack into new subproblems.  The
+        # deepest entries are undone first, since their checkpoints are
+        # the furthest along the trail, and the list is then reversed so
+        # that the deepest first move ends up last.
+        subproblems = []
+        while len(stack) > 0:
+            (mark, branches, i_branch) = stack.pop()
+            if branches is None:
+                continue
+
+            p.undo(mark)
+            state = p.get_state()
+            depth = len(stack) + 1 + base_depth
+            for move in reversed(branches[i_branch:]):
+                subproblems.append((state, move, depth))
+
+        subproblems.reverse()
+        return ('split', subproblems, stats.nodes, stats.max_depth)
+
+    else:
+        return (status, None, stats.nodes, stats.max_depth)
+
+
+def search_parallel(p, worklist, rng, seed, heuristic, stats, jobs,
+                    node_limit=500):
+    '''
+    Searches for a solution using a pool of jobs worker processes.  Once
+    the rules stop making progress on the initial board, the search is
+    split into subproblems, each one a board state plus a move to make on
+    it, and these are handed out to the workers.  A worker that reaches
+    node_limit nodes without finishing its subproblem hands back what it
+    has left as new subproblems, so idle workers can pick them up.  The
+    first worker to find a solution tells the others to stop.
+
+    The random number generator rng picks the first edge to branch on, and
+    the workers seed their own generators from seed.  Only the first few
+    levels of the search, which are expanded here, print their progress.
+    '''
+    result = start_search(p, worklist, stats)
+    if result is not None:
+        return result
+
+    branches = BRANCHING_HEURISTICS[heuristic](p, rng)
+    if branches is None:
+        log.info("Couldn't solve puzzle.")
+        stats.event('failed', nodes=stats.nodes)
+        return False
+
+    # The pending subproblems are used as a stack, so that the one that a
+    # serial depth-first search would try next is always at the end.
+    state = p.get_state()
+    pending = [(state, move, 2) for move in reversed(branches)]
+
+    def make_task(subproblem, limit):
+        return (p.rows, p.cols, p.clues, subproblem,
+                (worklist, p.vectorized, p.probe_limit, heuristic, seed,
+                 limit))
+
+    # Expand the first few levels of the search here, until there are
+    # enough subproblems to keep all of the workers busy.
+    while 0 < len(pending) < 4 * jobs:
+        (status, result, nodes, max_depth) = \
+            solve_subproblem(make_task(pending.pop(), 1), verbose=True)
+        stats.merge(nodes, max_depth)
+
+        if status == 'solved':
+            p.load_state(result)
+            log.info("Expanded %d search nodes.", stats.nodes)
+            stats.event('solved', depth=None, nodes=stats.nodes)
+            return True
+
+        elif status == 'split':
+            pending.extend(result)
+
+    stop = multiprocessing.Event()
+    solution = None
+
+    with futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                     initargs=(stop, CHECK_BOUNDS)) as executor:
+        running = set()
+        while solution is None and (len(pending) > 0 or len(running) > 0):
+            # Keep a couple of subproblems queued up for every worker.
+            # Taking them from the end of the stack keeps the search
+            # mostly depth-first.
+            while len(pending) > 0 and len(running) < 2 * jobs:
+                task = make_task(pending.pop(), node_limit)
+                running.add(executor.submit(solve_subproblem, task))
+
+            (done, running) = futures.wait(running,
+                return_when=futures.FIRST_COMPLETED)
+
+            for future in done:
+                (status, result, nodes, max_depth) = future.result()
+                stats.merge(nodes, max_depth)
+
+                if status == 'solved' and solution is None:
+                    solution = result
+                    stop.set()
+                    for other in running:
+                        other.cancel()
+
+                elif status == 'split':
+                    pending.extend(result)
+
+    if solution is not None:
+        p.load_state(solution)
+        log.info("Expanded %d search nodes.", stats.nodes)
+        stats.event('solved', depth=None, nodes=stats.nodes)
+        return True
+
+    log.info("Couldn't solve puzzle after expanding %d search nodes.",
+             stats.nodes)
+    stats.event('failed', nodes=stats.nodes)
+    return False
+
+
+def search_with_copies(p, worklist, rng, stats, table):
+    '''
+    Searches for a solution by copying the puzzle for every move from the
+    current board, and picking the next board to try at random using the
+    random number generator rng.  Only some of the moves from each board
+    are kept, so this search can miss solutions.
+
+    Different orders of moves often lead to the same board, so the hashes
+    of the boards tried so far are kept in the transposition table, and
+    boards found there are skipped.
+    '''
     attempts = []
-    board_set = set()
     skipped = 0
 
     assert p.can_solve(), "solve-puzzle was handed a board it couldn't solve!"
@@ -954,42 +3757,67 @@ def solve_puzzle(p):
     info = (p, 1, None, 0, 0)
     attempts.append(info)
 
+    logging_nodes = log.isEnabledFor(logging.DEBUG)
+
     while len(attempts) > 0:
-        print("%d more board configurations to try." % len(attempts))
+        if logging_nodes:
+            log.debug("%d more board configurations to try.", len(attempts))
 
         # info = attempts.pop(0)
-        info = attempts.pop(random.randint(0, len(attempts) - 1))
+        info = attempts.pop(rng.randint(0, len(attempts) - 1))
 
         (p, depth, move, i_move, n_moves) = info
+        stats.add_node(depth, move)
 
-        if depth > 1:
-            print("DEPTH %d:  Move %d of %d:  %s  Attempting to solve." % \
-                (depth, i_move, n_moves, str(move)))
-        else:
-            print("Attempting initial solution.")
+        if logging_nodes:
+            if depth > 1:
+                log.debug("DEPTH %d:  Move %d of %d:  %s  Attempting to "
+                          "solve.", depth, i_move, n_moves, move)
+            else:
+                log.debug("Attempting initial solution.")
 
+        start_hash = p.board_hash
         try:
-            p.iter_solve()
+            p.iter_solve(worklist=worklist)
+            probe_edges(p, worklist)
         except MoveError:
-            print("Encountered an invalid move.  Abandoning this path.")
-            # failures.add(p_copy.get_board_as_string())
+            if logging_nodes:
+                log.debug("Encountered an invalid move.  Abandoning this path.")
+            stats.event('contradiction', depth=depth)
             continue
 
+        if p.board_hash != start_hash:
+            # The rules may have turned this board into one we have seen.
+            if table.lookup(p.board_hash):
+                if logging_nodes:
+                    log.debug("Already tried this configuration, abandoning.")
+                skipped += 1
+                continue
+            table.add(p.board_hash)
+
         if p.is_solved():
-            print("DEPTH %d:  SOLVED" % depth)
-            p.pretty_print()
+            log.info("DEPTH %d:  SOLVED", depth)
+            log.info("Expanded %d search nodes.", stats.nodes)
+            log_table_stats(table, skipped)
+            stats.event('solved', depth=depth, nodes=stats.nodes)
             return True
 
-        elif not p.can_solve():
-            print("Couldn't solve this configuration, abandoning.")
+        elif not p.can_solve() or not p.can_form_loop():
+            if logging_nodes:
+                log.debug("Couldn't solve this configuration, abandoning.")
+            stats.event('contradiction', depth=depth)
             continue
 
         else:
-            print("DEPTH %d:  NOT SOLVED (change-count = %d)" % (depth, p.change_count))
+            if logging_nodes:
+                log.debug("DEPTH %d:  NOT SOLVED (change-count = %d)",
+                          depth, p.change_count)
 
             # Enumerate the remaining moves from this board.
             moves = p.enumerate_moves()
-            print("From this board configuration, found %d more moves." % len(moves))
+            if logging_nodes:
+                log.debug("From this board configuration, found %d more "
+                          "moves.", len(moves))
 
             '''
             # Show the move options:
@@ -1013,39 +3841,166 @@ def solve_puzzle(p):
                 p_copy.clear_changed_count()
                 p_copy.apply_move(move)
                 
-                board_str = p_copy.get_board_as_string()
-                if board_str in board_set:
-                    print(" * SKIPPING move - it's already enqueued")
+                if table.lookup(p_copy.board_hash):
+                    if logging_nodes:
+                        log.debug(" * SKIPPING move - it's already enqueued")
                     skipped += 1
                     continue
 
                 new_moves += 1
                 info = (p_copy, depth + 1, move, i + 1, total_moves)
                 #attempts.append(info)
-                #board_set.add(board_str)
                 move_infos.append(info)
 
             # Keep only some of the moves we found.
             if len(move_infos) > 10:
-                random.shuffle(move_infos)
+                rng.shuffle(move_infos)
                 move_infos = move_infos[:10]
                 new_moves = len(move_infos)
 
-            attempts.extend(move_infos)
-            print("Added %d new moves to the set of attempts." % new_moves)
+            # Only the boards we kept are recorded as seen, so that the
+            # others can still be tried if another move leads to them.
+            for info in move_infos:
+                table.add(info[0].board_hash)
 
-    print("Couldn't solve puzzle.")
+            attempts.extend(move_infos)
+            if logging_nodes:
+                log.debug("Added %d new moves to the set of attempts.",
+                          new_moves)
+
+    log.info("Couldn't solve puzzle after expanding %d search nodes.",
+             stats.nodes)
+    log_table_stats(table, skipped)
+    stats.event('failed', nodes=stats.nodes)
     return False
 
 
-if len(sys.argv) == 2:
-    puzzle_filename = sys.argv[1]
+def log_table_stats(table, skipped):
+    log.info("Transposition table:  %d boards, %d hits, %d misses, "
+             "%d evictions; skipped %d boards.", len(table), table.hits,
+             table.misses, table.evictions, skipped)
 
-    p = load_puzzle(puzzle_filename)
-    p.pretty_print()
+
+def positive_int(text):
+    '''
+    Argument type for command-line options that take a count of at least 1.
+    '''
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not %d" % value)
+    return value
+
+
+def main():
+    global CHECK_BOUNDS
+
+    parser = argparse.ArgumentParser(description='Solves a Slitherlink puzzle.')
+    parser.add_argument('filename', help='the puzzle file to solve')
+    parser.add_argument('--index', type=int, default=0,
+        help='which puzzle to solve, counting from 0, if the file holds ' +
+             'more than one (default 0)')
+    parser.add_argument('--sweep', action='store_true',
+        help='apply the rules by sweeping the whole board on every pass, ' +
+             'instead of only re-checking the positions that changed')
+    parser.add_argument('--numpy', action='store_true',
+        help='apply the simplest rules to the whole board at once with ' +
+             'NumPy, if it is installed')
+    parser.add_argument('--probes', type=int, default=0, metavar='N',
+        help='before branching, try up to N edge values at each search ' +
+             'node to find edges that can only take one value (default 0)')
+    parser.add_argument('--copy-boards', action='store_true',
+        help='use the older random search, which copies the board for ' +
+             'every move, instead of the depth-first search')
+    parser.add_argument('--heuristic', choices=sorted(BRANCHING_HEURISTICS),
+        default='constrained',
+        help='how the depth-first search picks the edge to branch on')
+    parser.add_argument('--table-size', type=int, default=100000,
+        help='the number of boards the --copy-boards search remembers, ' +
+             'so that it can skip boards it has already tried; it has no ' +
+             'effect on the depth-first search')
+    parser.add_argument('--jobs', type=positive_int,
+        help='the number of worker processes to split the depth-first ' +
+             'search across (default 1)')
+    parser.add_argument('--seed', type=int,
+        help='seed for the random choices made during the search; by ' +
+             'default the depth-first search makes no random choices')
+    parser.add_argument('--count-solutions', type=positive_int,
+        metavar='LIMIT',
+        help='count the solutions of the puzzle, up to LIMIT of them, ' +
+             'instead of stopping at the first one; e.g. 2 checks that ' +
+             'the solution is unique')
+    parser.add_argument('--check-bounds', action='store_true',
+        help='check every board position the solver reads or sets; ' +
+             'this is slower, and only useful for debugging')
+    parser.add_argument('--rule-stats', action='store_true',
+        help='count and time the work done by each rule, and print a ' +
+             'report at the end; this slows the rules down')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+        help='report every search node; given twice, also report the ' +
+             'work done by the rules')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='only print the solution')
+
+    args = parser.parse_args()
+    if args.numpy and args.sweep:
+        parser.error('--numpy only applies to the worklist rules, ' +
+                     'not --sweep')
+    if args.jobs is not None and args.copy_boards:
+        parser.error('--jobs only applies to the depth-first search, ' +
+                     'not --copy-boards')
+    if args.count_solutions is not None and \
+       (args.copy_boards or args.jobs is not None):
+        parser.error('--count-solutions only works with the single-process ' +
+                     'depth-first search')
+
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose == 0:
+        level = logging.INFO
+    elif args.verbose == 1:
+        level = logging.DEBUG
+    else:
+        level = TRACE
+    logging.basicConfig(format='%(message)s', level=level, stream=sys.stdout)
+
+    CHECK_BOUNDS = args.check_bounds
+
+    if args.numpy and numpy is None:
+        log.warning('NumPy is not installed; using the ordinary rules.')
+
+    try:
+        p = load_puzzle(args.filename, args.index)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.rule_stats:
+        p.rule_stats = RuleStats()
+    if not args.quiet:
+        p.pretty_print()
     #print("Raw string:\n%s" % p.get_board_as_string())
-    solve_puzzle(p)
+    if args.count_solutions is not None:
+        count = count_solutions(p, args.count_solutions,
+                                worklist=not args.sweep, seed=args.seed,
+                                heuristic=args.heuristic,
+                                vectorized=args.numpy, probes=args.probes)
+        if count == 1:
+            print('The solution is unique.')
+        elif count == args.count_solutions and count > 1:
+            print('The puzzle has at least %d solutions.' % count)
+        else:
+            print('The puzzle has %d solutions.' % count)
+
+        if count > 0:
+            p.pretty_print()
+
+    elif solve_puzzle(p, worklist=not args.sweep, in_place=not args.copy_boards,
+                    seed=args.seed, heuristic=args.heuristic,
+                    table_size=args.table_size, jobs=args.jobs or 1,
+                    vectorized=args.numpy, probes=args.probes):
+        p.pretty_print()
+
+    if args.rule_stats:
+        print(p.rule_stats.report())
 
-else:
-    print("usage:  %s filename" % sys.argv[0])
 
+if __name__ == '__main__':
+    main()